@@ -0,0 +1,214 @@
+# benchmarks/micro.py
+"""
+Micro-benchmarks for the numeric hot paths, with regression thresholds.
+
+Each case is timed (best per-call time over several repeats) and its peak
+Python memory is measured with tracemalloc. Results are compared against
+benchmarks/baseline.json and the run fails if a case got slower or uses more
+memory than the baseline allows:
+
+    python benchmarks/micro.py                     # compare against the baseline
+    python benchmarks/micro.py --update-baseline   # record a new baseline
+    python benchmarks/micro.py --filter pred       # only cases containing "pred"
+
+Timings depend on the machine, so the baseline should be recorded on the
+same machine (or CI runner type) that runs the comparison.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np
+
+from replay import HISTORY_PATH, load_history, nyiso_day_body
+from data_processing.store import HistoryStore
+
+
+def load_history_data() -> np.ndarray:
+    _, values = HistoryStore(HISTORY_PATH).read(columns=["price", "emission"], dtype=float)
+    return values
+
+def make_cases() -> dict:
+    """Returns {name: zero-argument callable}; setup happens here, outside the timed calls."""
+    from pred import pred, batch_savings
+    from scheduler import batch_schedules, optimal_schedule
+    from retrieve_data import NyisoPriceBuffer
+    from data_processing.training import create_sequences, forecast, get_forecasts, FORECASTER, ForecastService
+    from main import format_forecast_message
+
+    rng = np.random.default_rng(0)
+    data = load_history_data()
+    forecasted_24 = np.column_stack([rng.random(24) * 0.2, rng.random(24) * 300 + 100])
+    departure = datetime.now() + timedelta(hours=23, minutes=30)
+    cases = {}
+
+    # pred: charging windows of 1, 4 and 12 hours for a 60 kWh battery at 5 kW
+    for hours in (1, 4, 12):
+        soc = 100 - hours * 5 / 60 * 100
+        cases[f"pred/hours={hours}"] = lambda soc=soc: pred(soc, departure, 60, 5, forecasted_24)
+
+    for n in (1, 100, 10000):
+        soc = rng.random(n) * 80
+        hours_until_departure = rng.random(n) * 14 + 10
+        cases[f"batch_savings/users={n}"] = (
+            lambda soc=soc, h=hours_until_departure: batch_savings(soc, h, 60, 7, forecasted_24)
+        )
+        cases[f"batch_schedules/users={n}"] = (
+            lambda soc=soc, h=hours_until_departure: batch_schedules(
+                forecasted_24, 60 * (100 - soc) / 100, 7, h)
+        )
+
+    FORECASTER.warmup()
+    price_vector, carbon_vector = data[-24:, 0], data[-24:, 1]
+    cases["get_forecasts"] = lambda: get_forecasts(price_vector, carbon_vector)
+    cases["forecast"] = lambda: forecast(carbon_vector, price_vector)
+    windows = np.stack([data[start:start + 24] for start in range(0, 64 * 24, 24)])
+    cases["forecast_batch/windows=64"] = lambda: FORECASTER.forecast_batch(windows)
+    numpy_forecaster = ForecastService(backend="numpy")
+    cases["forecast/backend=numpy"] = lambda: numpy_forecaster.forecast(price_vector, carbon_vector)
+
+    for history in (24, 168):
+        cases[f"create_sequences/history={history}"] = (
+            lambda history=history: create_sequences(data, history=history, forecast=24)
+        )
+
+    # Time-range reads from the history store: a day, and the fine-tuning window
+    store = HistoryStore(HISTORY_PATH)
+    last = store.last_time()
+    for hours in (24, 24 * 90):
+        cases[f"history_store/read_hours={hours}"] = (
+            lambda start=last - np.timedelta64(hours, "h"): store.read(start=start)
+        )
+
+    # The NYISO ingestion behind get_data, fed from local CSV fixtures
+    recorded = load_history()
+    end_time = datetime.now().replace(minute=0, second=0, microsecond=0)
+    for days in (1, 2):
+        dates = [(end_time - timedelta(days=days - 1 - i)).strftime("%Y%m%d") for i in range(days)]
+        texts = [nyiso_day_body(recorded, date).decode() for date in dates]
+
+        def ingest(dates=dates, texts=texts):
+            buffer = NyisoPriceBuffer()
+            for date, text in zip(dates, texts):
+                buffer.ingest(date, text)
+            buffer.evict(end_time)
+            return buffer.hourly_prices(end_time)
+
+        cases[f"nyiso_ingest/days={days}"] = ingest
+
+    schedule = optimal_schedule(forecasted_24, 30, 7, 23.5)
+    savings, hours_to_charge = pred(50, departure, 60, 7, forecasted_24)
+    cases["format_forecast_message"] = lambda: format_forecast_message(savings, hours_to_charge, schedule)
+
+    return cases
+
+def measure(func, repeats: int = 5, min_time: float = 0.05) -> dict:
+    """Returns the best per-call wall time in seconds and the peak traced memory in bytes."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()  # warm up
+
+        # Enough calls per repeat to get above timer noise
+        loops = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time or loops >= 1_000_000:
+                break
+            loops *= 10
+
+        best = elapsed / loops
+        for _ in range(repeats - 1):
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            best = min(best, (time.perf_counter() - start) / loops)
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {"time_s": best, "peak_bytes": peak}
+
+def compare(results: dict, baseline: dict, time_tolerance: float, memory_tolerance: float) -> list:
+    """Returns a description of every case that regressed beyond the tolerances."""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        # Absolute slack as well, so scheduler jitter on sub-millisecond cases doesn't trip the check
+        if result["time_s"] > reference["time_s"] * (1 + time_tolerance) + 100e-6:
+            regressions.append(f"{name}: time {result['time_s'] * 1e3:.3f} ms "
+                               f"vs baseline {reference['time_s'] * 1e3:.3f} ms")
+        # Likewise for tiny allocations
+        if result["peak_bytes"] > reference["peak_bytes"] * (1 + memory_tolerance) + 4096:
+            regressions.append(f"{name}: peak memory {result['peak_bytes']} B "
+                               f"vs baseline {reference['peak_bytes']} B")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--time-tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown before failing (default 0.25)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10,
+                        help="allowed relative peak memory growth before failing (default 0.10)")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    # Importing the bot needs neither Gemini nor a database in the repo
+    os.environ.setdefault("LLM_BACKEND", "stub")
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+
+    results = {}
+    for name, func in make_cases().items():
+        if args.filter not in name:
+            continue
+        results[name] = measure(func)
+        print(f"{name:40s} {results[name]['time_s'] * 1e3:10.3f} ms "
+              f"{results[name]['peak_bytes'] / 1024:10.1f} KiB")
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        sys.exit(f"No baseline at {args.baseline}; record one with --update-baseline")
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\nNo regressions.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# benchmarks/replay.py
+"""
+Offline end-to-end latency benchmark for the charging pipeline.
+
+Replays ElectricityMaps and NYISO responses built from the NYC history
+store (data_processing/history/NYC) through a local HTTP
+server, replaces Gemini with a StubLLM and Telegram with fake updates, then
+drives simulated users through registration and charging queries.
+
+    python benchmarks/replay.py --users 200 --concurrency 50 --output run.json
+
+Prints (or writes) a JSON report with p50/p95/p99 latency per stage and
+overall throughput, so runs can be compared.
+"""
+import argparse
+import asyncio
+import contextlib
+import http.server
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_PATH = os.path.join(REPO_ROOT, "data_processing", "history", "NYC")
+# Retail $/kWh in the store back to wholesale $/MWh (see data_collection.py)
+RETAIL_MULTIPLIER = 4.24
+NYISO_ZONES = ["CAPITL", "N.Y.C.", "WEST"]
+
+# Departures are half a day out so every plan is feasible whenever the benchmark runs
+DEPARTURE = datetime.now() + timedelta(hours=12)
+DEPARTURE_12H = DEPARTURE.strftime("%I:%M %p").lstrip("0")
+DEPARTURE_24H = DEPARTURE.strftime("%H:%M")
+
+REGISTRATION_ANSWERS = ["60 kWh", "7.4 kW", DEPARTURE_12H]
+CLEAR_CHARGING_MESSAGES = [
+    "Battery is at 45%", f"30% leave {DEPARTURE_12H}", f"battery at 62% leaving at {DEPARTURE_24H}"
+]
+# The local parser is unsure about these, so they go through the (stub) LLM
+FUZZY_CHARGING_MESSAGES = ["battery is at 45 and I leave around 7", "about half full, out at 8ish"]
+
+
+# ---------------------------
+# Recorded upstream responses
+# ---------------------------
+
+def load_history(path: str = HISTORY_PATH) -> dict:
+    """Returns {datetime: (price, emission)} from a history store."""
+    from data_processing.store import HistoryStore
+
+    times, values = HistoryStore(path).read(columns=["price", "emission"], dtype=float)
+    return {stamp: (price, emission) for stamp, (price, emission) in zip(times.tolist(), values.tolist())}
+
+def recorded_hour(history: dict, stamp: datetime):
+    """Maps a live timestamp onto the same month, day and hour of the recorded year."""
+    year = next(iter(history)).year
+    try:
+        recorded = stamp.replace(year=year, minute=0, second=0, microsecond=0)
+    except ValueError:  # Feb 29 outside a leap year
+        recorded = stamp.replace(year=year, day=28, minute=0, second=0, microsecond=0)
+    return history.get(recorded)
+
+def carbon_history_body(history: dict, now: datetime) -> bytes:
+    items = []
+    for i in range(24, 0, -1):
+        stamp = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=i - 1)
+        _, emission = recorded_hour(history, stamp) or (None, 0.0)
+        items.append({"datetime": stamp.isoformat(), "carbonIntensity": emission})
+    return json.dumps({"zone": "US-NY-NYIS", "history": items}).encode()
+
+def nyiso_day_body(history: dict, date: str) -> bytes:
+    day = datetime.strptime(date, "%Y%m%d")
+    lines = ['"Time Stamp","Name","PTID","LBMP ($/MWHr)","Marginal Cost Losses ($/MWHr)",'
+             '"Marginal Cost Congestion ($/MWHr)"']
+    for k in range(288):
+        stamp = day + timedelta(minutes=5 * k)
+        price, _ = recorded_hour(history, stamp) or (float("nan"), None)
+        lbmp = price * 1000 / RETAIL_MULTIPLIER
+        for ptid, zone in enumerate(NYISO_ZONES):
+            lines.append(f"{stamp:%m/%d/%Y %H:%M:%S},{zone},{61750 + ptid},{lbmp:.2f},0.00,0.00")
+    return "\n".join(lines).encode()
+
+def start_fixture_server(history: dict, latency: float) -> http.server.ThreadingHTTPServer:
+    """Serves recorded ElectricityMaps and NYISO responses on a free local port."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            path = urlparse(self.path).path
+            if path.startswith("/electricitymaps/carbon-intensity/history"):
+                body = carbon_history_body(history, datetime.now())
+            elif path.startswith("/nyiso/") and path.endswith("realtime_zone.csv"):
+                body = nyiso_day_body(history, path.rsplit("/", 1)[1][:8])
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------------------------
+# Fake Telegram objects
+# ---------------------------
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+    def mention_html(self) -> str:
+        return f'<a href="tg://user?id={self.id}">user {self.id}</a>'
+
+
+class FakeMessage:
+    def __init__(self, text: str, timings):
+        self.text = text
+        self.replies = []
+        self._timings = timings
+
+    async def reply_text(self, text, **kwargs):
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        self.replies.append(text)
+        self._timings["telegram_reply"].append(time.perf_counter() - start)
+
+    async def reply_html(self, text, **kwargs):
+        await self.reply_text(text, **kwargs)
+
+
+class FakeUpdate:
+    def __init__(self, user: FakeUser, text: str, timings):
+        self.effective_user = user
+        self.message = FakeMessage(text, timings)
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+def stub_llm_reply(messages) -> str:
+    """Answers the extraction prompts in reg.py the way Gemini would."""
+    prompt = messages[-1].content
+    if "state of charge" in prompt:
+        return f"45, {DEPARTURE_12H}"
+    if "battery capacity" in prompt:
+        return "60"
+    if "charging rate" in prompt:
+        return "7.4"
+    if "HH:MM AM/PM" in prompt:
+        return DEPARTURE_12H
+    return "OK"
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+
+def timed(name: str, func, timings):
+    """Wraps an async or sync function so each call's duration is recorded under `name`."""
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                timings[name].append(time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[name].append(time.perf_counter() - start)
+    return wrapper
+
+def percentiles(samples) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": pick(0.50) * 1000,
+        "p95_ms": pick(0.95) * 1000,
+        "p99_ms": pick(0.99) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+async def simulate_user(main, user_id: int, queries: int, fuzzy_ratio: float, timings, errors, rng):
+    user = FakeUser(user_id)
+    context = FakeContext()
+    # Wrapped as main() registers it, under the user's lock
+    handle_message = main.per_user(main.handle_message)
+
+    async def send(stage: str, text: str):
+        update = FakeUpdate(user, text, timings)
+        start = time.perf_counter()
+        await handle_message(update, context)
+        timings[stage].append(time.perf_counter() - start)
+        if any("couldn't" in reply for reply in update.message.replies):
+            errors[stage] += 1
+
+    # First contact starts the registration, then one message per question
+    await send("first_contact", "hi")
+    for answer in REGISTRATION_ANSWERS:
+        await send("registration", answer)
+
+    for _ in range(queries):
+        messages = FUZZY_CHARGING_MESSAGES if rng.random() < fuzzy_ratio else CLEAR_CHARGING_MESSAGES
+        await send("charging", rng.choice(messages))
+
+async def run(args) -> dict:
+    import main
+    import llm
+    import reg
+
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+
+    reg.initialize_database()
+    llm.set_llm(llm.StubLLM(reply=stub_llm_reply, latency=args.llm_latency))
+
+    # Per-stage timings inside handle_charging_input
+    main.process_charging_input = timed("parse_charging_input", main.process_charging_input, timings)
+    main.aget_hourly_forecast = timed("forecast", main.aget_hourly_forecast, timings)
+    main.pred = timed("pred", main.pred, timings)
+    main.optimal_schedule = timed("schedule", main.optimal_schedule, timings)
+    main.get_user_profile = timed("profile_lookup", main.get_user_profile, timings)
+    reg.process_user_input = timed("parse_registration_input", reg.process_user_input, timings)
+
+    rng = random.Random(args.seed)
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id):
+        async with slots:
+            await simulate_user(main, user_id, args.queries, args.fuzzy_ratio, timings, errors,
+                                random.Random(rng.random()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - start
+
+    from db import MESSAGE_LOG
+    await MESSAGE_LOG.close()
+
+    messages = sum(len(timings[s]) for s in ("first_contact", "registration", "charging"))
+    return {
+        "config": vars(args),
+        "elapsed_s": elapsed,
+        "throughput": {
+            "messages_per_s": messages / elapsed,
+            "charging_queries_per_s": len(timings["charging"]) / elapsed,
+        },
+        "errors": dict(errors),
+        "parse_stats": dict(reg.PARSE_STATS),
+        "stages": {name: percentiles(samples) for name, samples in sorted(timings.items())},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="simulated users")
+    parser.add_argument("--concurrency", type=int, default=20, help="users served at the same time")
+    parser.add_argument("--queries", type=int, default=3, help="charging queries per user")
+    parser.add_argument("--fuzzy-ratio", type=float, default=0.2,
+                        help="share of charging messages the local parser can't read")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="stub LLM latency in seconds")
+    parser.add_argument("--upstream-latency", type=float, default=0.2,
+                        help="fixture server latency per request in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    server = start_fixture_server(load_history(), args.upstream_latency)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["ELECTRICITYMAPS_BASE_URL"] = f"{base}/electricitymaps"
+    os.environ["NYISO_BASE_URL"] = f"{base}/nyiso"
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ.setdefault("emission_api_token", "replay")
+
+    # The bot keeps its SQLite database in the working directory. Whatever it prints
+    # goes to stderr, so the report is the only thing on stdout
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        os.chdir(workdir)
+        report = asyncio.run(run(args))
+        os.chdir(REPO_ROOT)
+    server.shutdown()
+
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
+import os
+import sys
 import pandas as pd
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from zones import get_zone, seed_path
+from data_processing.store import HistoryStore
+
+# Zone to build the training data for, e.g. `python data_collection.py NYC` (default zone if omitted)
+zone = get_zone(sys.argv[1] if len(sys.argv) > 1 else None)
+
 # Load the data files
-lbmp_file = "OASIS_Real_Time_Dispatch_Zonal_LBMP.csv"
-emission_file = "US-NY-NYIS_2024_hourly.csv"
+lbmp_file = zone.lbmp_file
+emission_file = zone.emission_file
 
 # Load the data into DataFrames
 lbmp_df = pd.read_csv(lbmp_file, parse_dates=['RTD End Time Stamp'])
@@ -12,7 +21,7 @@ emission_df = pd.read_csv(emission_file, parse_dates=['Datetime (UTC)'])
 lbmp_df = lbmp_df[['RTD End Time Stamp', 'RTD Zonal LBMP']]
 lbmp_df.rename(columns={'RTD End Time Stamp': 'time', 'RTD Zonal LBMP': 'price'}, inplace=True)
 lbmp_df['price'] = lbmp_df['price'] / 1000  # Convert $/MWh to $/kWh
-lbmp_df['price'] = lbmp_df['price'] * 4.24  # Approximate residential rate multiplier
+lbmp_df['price'] = lbmp_df['price'] * zone.price_multiplier  # Approximate residential rate multiplier
 """"
 To approximate residential electricity prices in New York City based on wholesale market rates, it's essential to understand the relationship between wholesale and retail pricing. Residential rates encompass additional costs beyond the wholesale price, including transmission, distribution, maintenance, administrative expenses, and taxes.
 
@@ -69,8 +78,14 @@ merged_df = pd.merge_asof(
 
 merged_df['price'] = merged_df['price'].fillna(method='ffill')  # forward fill
 
-# Save or display the resulting DataFrame
+# Display the resulting DataFrame
 print(merged_df.head())
 
-# Optionally save to a new CSV
-merged_df.to_csv("combined_electricity_data_hourly.csv", index=False)
+# Append to the zone's committed history snapshot; hours it already has are skipped, so
+# re-running with a newer export only adds the new hours
+appended = HistoryStore(seed_path(zone.history_store)).append(
+    merged_df['time'].to_numpy(),
+    price=merged_df['price'].to_numpy(),
+    emission=merged_df['emission'].to_numpy(),
+)
+print(f"Appended {appended} hours to {seed_path(zone.history_store)}")
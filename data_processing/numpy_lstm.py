@@ -0,0 +1,197 @@
+# numpy_lstm.py
+"""
+TensorFlow-free inference for the seq2seq LSTM forecaster.
+
+export_weights() reads trained_model.h5 with h5py and writes its weights and
+activations to a small .npz file; NumpyLSTMForecaster runs the same forward
+pass (LSTM encoder -> RepeatVector -> LSTM decoder -> TimeDistributed Dense)
+with NumPy only, for a single window or a batch of windows.
+
+    python data_processing/numpy_lstm.py            # export trained_model.npz
+    python data_processing/numpy_lstm.py --check    # export, then compare with Keras
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+H5_PATH = os.path.join(DATA_DIR, "trained_model.h5")
+NPZ_PATH = os.path.join(DATA_DIR, "trained_model.npz")
+HISTORY_PATH = os.path.join(DATA_DIR, "history", "NYC")
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    # Same function as 1 / (1 + exp(-x)), without overflowing for large negative x
+    "sigmoid": lambda x: 0.5 * (1 + np.tanh(0.5 * x)),
+}
+
+# Layer sequence the forward pass implements, as written by train_lstm_model
+ARCHITECTURE = ["LSTM", "RepeatVector", "LSTM", "TimeDistributed"]
+
+
+def export_weights(h5_path: str = H5_PATH, npz_path: str = NPZ_PATH) -> str:
+    """
+    Extracts the forecaster's weights from a Keras .h5 file into a .npz file.
+
+    Args:
+        h5_path: The model saved by train_lstm_model.
+        npz_path: Where to write the weights.
+
+    Returns:
+        npz_path
+    """
+    import h5py
+
+    with h5py.File(h5_path, "r") as f:
+        config = json.loads(f.attrs["model_config"])
+        layers = [layer for layer in config["config"]["layers"] if layer["class_name"] != "InputLayer"]
+        if [layer["class_name"] for layer in layers] != ARCHITECTURE:
+            raise ValueError(f"Unsupported model architecture in {h5_path}: "
+                             f"{[layer['class_name'] for layer in layers]}")
+
+        weights = f["model_weights"]
+
+        def layer_weights(name):
+            group = weights[name]
+            return [np.asarray(group[weight_name], dtype=np.float32)
+                    for weight_name in group.attrs["weight_names"]]
+
+        encoder, repeat, decoder, dense = layers
+        encoder_kernel, encoder_recurrent_kernel, encoder_bias = layer_weights(encoder["config"]["name"])
+        decoder_kernel, decoder_recurrent_kernel, decoder_bias = layer_weights(decoder["config"]["name"])
+        dense_kernel, dense_bias = layer_weights(dense["config"]["name"])
+
+    # Written to a temporary file first so a running bot never loads half an export
+    tmp_path = npz_path + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        encoder_kernel=encoder_kernel,
+        encoder_recurrent_kernel=encoder_recurrent_kernel,
+        encoder_bias=encoder_bias,
+        encoder_activation=encoder["config"]["activation"],
+        encoder_recurrent_activation=encoder["config"]["recurrent_activation"],
+        horizon=repeat["config"]["n"],
+        decoder_kernel=decoder_kernel,
+        decoder_recurrent_kernel=decoder_recurrent_kernel,
+        decoder_bias=decoder_bias,
+        decoder_activation=decoder["config"]["activation"],
+        decoder_recurrent_activation=decoder["config"]["recurrent_activation"],
+        dense_kernel=dense_kernel,
+        dense_bias=dense_bias,
+        dense_activation=dense["config"]["layer"]["config"]["activation"],
+    )
+    os.replace(tmp_path, npz_path)
+    return npz_path
+
+
+class NumpyLSTMForecaster:
+    """
+    NumPy forward pass of the seq2seq LSTM, matching Keras to float32 precision.
+
+    Keras packs the four LSTM gates as [input, forget, cell, output] along the
+    last axis of each kernel, which is the order used here.
+    """
+
+    def __init__(self, npz_path: str = NPZ_PATH):
+        with np.load(npz_path) as weights:
+            self.encoder = self._lstm(weights, "encoder")
+            self.decoder = self._lstm(weights, "decoder")
+            self.horizon = int(weights["horizon"])
+            self.dense_kernel = weights["dense_kernel"]
+            self.dense_bias = weights["dense_bias"]
+            self.dense_activation = ACTIVATIONS[str(weights["dense_activation"])]
+
+    @staticmethod
+    def _lstm(weights, prefix: str) -> tuple:
+        return (
+            weights[f"{prefix}_kernel"],
+            weights[f"{prefix}_recurrent_kernel"],
+            weights[f"{prefix}_bias"],
+            ACTIVATIONS[str(weights[f"{prefix}_activation"])],
+            ACTIVATIONS[str(weights[f"{prefix}_recurrent_activation"])],
+        )
+
+    @staticmethod
+    def _run_lstm(layer, inputs: np.ndarray, steps: int) -> np.ndarray:
+        """
+        Runs one LSTM layer and returns the hidden state after every step.
+
+        `inputs` is the input projection (x @ kernel + bias), either one per
+        step with shape (batch, steps, 4 * units) or, for the decoder whose
+        input repeats, a single (batch, 4 * units) shared by all steps.
+        """
+        _, recurrent_kernel, _, activation, recurrent_activation = layer
+        units = recurrent_kernel.shape[0]
+        batch = inputs.shape[0]
+        h = np.zeros((batch, units), dtype=np.float32)
+        c = np.zeros((batch, units), dtype=np.float32)
+        outputs = np.empty((batch, steps, units), dtype=np.float32)
+        for t in range(steps):
+            z = (inputs[:, t] if inputs.ndim == 3 else inputs) + h @ recurrent_kernel
+            i = recurrent_activation(z[:, :units])
+            f = recurrent_activation(z[:, units:2 * units])
+            g = activation(z[:, 2 * units:3 * units])
+            o = recurrent_activation(z[:, 3 * units:])
+            c = f * c + i * g
+            h = o * activation(c)
+            outputs[:, t] = h
+        return outputs
+
+    def predict(self, windows: np.ndarray) -> np.ndarray:
+        """
+        Forecasts from a batch of input windows.
+
+        Args:
+            windows: Past observations, shape (batch, history, features).
+
+        Returns:
+            np.ndarray of shape (batch, horizon, features)
+        """
+        windows = np.asarray(windows, dtype=np.float32)
+        kernel, _, bias, _, _ = self.encoder
+        # The input projection of every step is a single matmul
+        encoded = self._run_lstm(self.encoder, windows @ kernel + bias, windows.shape[1])[:, -1]
+
+        kernel, _, bias, _, _ = self.decoder
+        decoded = self._run_lstm(self.decoder, encoded @ kernel + bias, self.horizon)
+        return self.dense_activation(decoded @ self.dense_kernel + self.dense_bias)
+
+
+def compare_with_keras(h5_path: str = H5_PATH, npz_path: str = NPZ_PATH, samples: int = 256) -> float:
+    """
+    Returns the largest difference between Keras and NumPy forecasts on windows
+    from the training data, relative to the size of each output feature.
+    """
+    from tensorflow.keras.models import load_model
+    try:
+        from data_processing.store import HistoryStore
+    except ImportError:  # run as a script from data_processing/
+        from store import HistoryStore
+
+    # Real windows: with random inputs the relu LSTM produces meaningless huge values
+    _, data = HistoryStore(HISTORY_PATH).read(columns=["price", "emission"])
+    starts = np.linspace(0, len(data) - 24, samples).astype(int)
+    windows = np.stack([data[start:start + 24] for start in starts])
+    windows = windows[~np.isnan(windows).any(axis=(1, 2))]
+
+    expected = load_model(h5_path).predict_on_batch(windows)
+    actual = NumpyLSTMForecaster(npz_path).predict(windows)
+    scale = np.abs(expected).max(axis=(0, 1))
+    return float(np.max(np.abs(expected - actual) / scale))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export trained_model.h5 for the NumPy forecaster.")
+    parser.add_argument("h5_path", nargs="?", default=H5_PATH)
+    parser.add_argument("npz_path", nargs="?", default=NPZ_PATH)
+    parser.add_argument("--check", action="store_true", help="compare the export against Keras")
+    args = parser.parse_args()
+
+    print(f"Wrote {export_weights(args.h5_path, args.npz_path)}")
+    if args.check:
+        print(f"Max difference vs Keras, relative to each feature's range: "
+              f"{compare_with_keras(args.h5_path, args.npz_path):.3g}")
@@ -0,0 +1,201 @@
+# retrain.py
+"""
+Incremental refresh of a zone's forecaster from the hours the bot observes live.
+
+The bot appends every hour's observed prices and carbon intensities to the
+zone's HistoryStore (append_observations). Once a day, fine_tune() runs
+in a separate process: it continues training the current model for a few
+epochs on the most recent window of that history, compares it with the
+current model on a holdout of the latest hours, and only if the error
+improves replaces the model files atomically. ForecastService notices the
+new file and reloads it, so serving never stops. The history and the model
+files are the zone's copies in RUNTIME_DIR (see zones.py), never the
+snapshot committed to the repository.
+
+    python -m data_processing.retrain --zone NYC
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from data_processing.training import create_sequences, valid_window_starts, make_dataset
+from data_processing.numpy_lstm import export_weights
+from data_processing.store import HistoryStore
+from zones import ZONES, DEFAULT_ZONE, get_zone, ensure_runtime_data
+
+# Hours of recent history fine-tuned on, and the latest of those held out for validation
+RETRAIN_WINDOW_HOURS = 24 * 90
+HOLDOUT_HOURS = 24 * 7
+FINE_TUNE_EPOCHS = 3
+FINE_TUNE_LEARNING_RATE = 1e-4
+# The new model must beat the current one on the holdout by at least this fraction
+MIN_IMPROVEMENT = 0.01
+
+# Daily time (HH:MM, local) at which the bot starts the retraining process
+RETRAIN_TIME = os.getenv("RETRAIN_TIME", "03:30")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# ---------------------------
+# Observed hours
+# ---------------------------
+
+_stores = {}  # history_store path -> HistoryStore
+
+def history_store(zone: str) -> HistoryStore:
+    """Returns the HistoryStore holding a zone's training history, seeding RUNTIME_DIR if needed."""
+    path = ensure_runtime_data(zone).history_store
+    if path not in _stores:
+        _stores[path] = HistoryStore(path)
+    return _stores[path]
+
+def append_observations(zone: str, hour: datetime, electricity_price_vector, carbon_intensity_vector,
+                        carbon_times) -> int:
+    """
+    Appends the observed hours before `hour` to the zone's training history.
+
+    The price vector holds the hours right before `hour`. Carbon intensities
+    are matched to those hours by their own timestamps (`carbon_times`), since
+    ElectricityMaps' history need not end where the prices do. Hours without
+    a carbon intensity get NaN, and intensities outside the price hours are left out.
+
+    Hours already in the history are skipped, so calling this again for the
+    same or an overlapping hour is harmless, and hours missing since the
+    last append become NaN rows, so no training window spans the gap.
+
+    Returns:
+        The number of rows written.
+    """
+    # Missing upstream values (None) become NaN
+    price = np.asarray(electricity_price_vector, dtype=float)
+    times = [hour - timedelta(hours=len(price) - i) for i in range(len(price))]
+    rows = {stamp: i for i, stamp in enumerate(times)}
+    emission = np.full(len(price), np.nan)
+    for stamp, value in zip(carbon_times, np.asarray(carbon_intensity_vector, dtype=float)):
+        if stamp in rows:
+            emission[rows[stamp]] = value
+    return history_store(zone).append(times, price=price, emission=emission)
+
+
+# ---------------------------
+# Fine-tuning
+# ---------------------------
+
+def holdout_error(model, data: np.ndarray, starts: np.ndarray, history=24, forecast=24) -> float:
+    """
+    Mean squared error over the windows at `starts`, per feature relative to the
+    variance of its targets, so prices and carbon intensities count equally.
+    """
+    X, Y = create_sequences(data, history, forecast)
+    targets = Y[starts]
+    predictions = np.concatenate([
+        model.predict_on_batch(X[starts[i:i + 256]].astype(np.float32))
+        for i in range(0, len(starts), 256)
+    ])
+    mse = ((predictions - targets) ** 2).mean(axis=(0, 1))
+    return float(np.mean(mse / targets.var(axis=(0, 1))))
+
+def fine_tune(zone: str = DEFAULT_ZONE, window_hours: int = RETRAIN_WINDOW_HOURS,
+              holdout_hours: int = HOLDOUT_HOURS, epochs: int = FINE_TUNE_EPOCHS,
+              learning_rate: float = FINE_TUNE_LEARNING_RATE, batch_size: int = 32,
+              history: int = 24, forecast: int = 24) -> dict:
+    """
+    Fine-tunes the zone's current model on its recent history and swaps it in if it is better.
+
+    `history` and `forecast` are the model's input and output lengths in hours.
+
+    Returns:
+        A report with the holdout errors before and after and whether the model was replaced.
+    """
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.optimizers import Adam
+
+    _, data = history_store(zone).tail(window_hours, columns=["price", "emission"])
+    zone = get_zone(zone)
+
+    # Holdout windows lie entirely within the last holdout_hours; training targets end before them
+    starts = valid_window_starts(data, history, forecast)
+    holdout_begin = len(data) - holdout_hours
+    train_idx = starts[starts + history + forecast <= holdout_begin]
+    holdout_idx = starts[starts >= holdout_begin]
+    report = {"zone": zone.name, "train_windows": len(train_idx), "holdout_windows": len(holdout_idx)}
+    if len(train_idx) < batch_size or len(holdout_idx) == 0:
+        report.update(replaced=False, reason="not enough history")
+        return report
+
+    current = load_model(zone.model_path)
+    report["current_error"] = holdout_error(current, data, holdout_idx, history, forecast)
+
+    candidate = load_model(zone.model_path)
+    candidate.compile(optimizer=Adam(learning_rate=learning_rate), loss="mse")
+    candidate.fit(make_dataset(data, train_idx, history, forecast, batch_size=batch_size, shuffle=True),
+                  epochs=epochs, verbose=0)
+    report["candidate_error"] = holdout_error(candidate, data, holdout_idx, history, forecast)
+
+    if report["candidate_error"] > report["current_error"] * (1 - MIN_IMPROVEMENT):
+        report.update(replaced=False, reason="no improvement on the holdout")
+        return report
+
+    # Saved next to the model and renamed over it, so a reader never sees half a file
+    tmp_path = zone.model_path + ".tmp.h5"
+    candidate.save(tmp_path)
+    os.replace(tmp_path, zone.model_path)
+    export_weights(zone.model_path, zone.npz_path)
+    report["replaced"] = True
+    return report
+
+
+# ---------------------------
+# Scheduling from the bot
+# ---------------------------
+
+_running = {}  # zone -> retraining process
+_reapers = set()  # tasks waiting for those processes to exit
+
+async def retrain_job(context) -> None:
+    """
+    JobQueue callback that fine-tunes every model in its own background process.
+
+    Zones sharing a model are fine-tuned once, and a zone whose previous run
+    is still going is skipped.
+    """
+    models = {}
+    for name, zone in ZONES.items():
+        models.setdefault(zone.model_path, name)
+
+    for name in models.values():
+        process = _running.get(name)
+        if process is not None and process.returncode is None:
+            print(f"Retraining for {name} is still running, skipping this run")
+            continue
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "data_processing.retrain", "--zone", name, cwd=REPO_ROOT
+        )
+        _running[name] = process
+        # Waiting sets returncode; the task is kept so it isn't garbage collected before the process exits
+        reaper = asyncio.get_running_loop().create_task(process.wait())
+        _reapers.add(reaper)
+        reaper.add_done_callback(_reapers.discard)
+
+def schedule_daily_retrain(job_queue, at: str = RETRAIN_TIME) -> None:
+    """Runs retrain_job every day at `at` (HH:MM, local time)."""
+    hour, minute = (int(part) for part in at.split(":"))
+    job_queue.run_daily(
+        retrain_job,
+        time=datetime.now().astimezone().timetz().replace(hour=hour, minute=minute, second=0, microsecond=0),
+        name="daily-retrain",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fine-tune a zone's forecaster on its recent history.")
+    parser.add_argument("--zone", default=DEFAULT_ZONE)
+    parser.add_argument("--epochs", type=int, default=FINE_TUNE_EPOCHS)
+    args = parser.parse_args()
+    print(json.dumps(fine_tune(args.zone, epochs=args.epochs)))
@@ -0,0 +1,252 @@
+# store.py
+"""
+Time-indexed columnar store for a zone's hourly price and emission history.
+
+A store is a directory holding one raw binary file per column, read through
+NumPy memory maps, and a small meta.json:
+
+    meta.json      {"columns": ["price", "emission"], "dtype": "float64", "step": 3600, "rows": N}
+    time.bin       int64 seconds since the epoch, strictly increasing
+    price.bin      one float per row
+    emission.bin   one float per row
+
+Rows are on a regular grid of `step` seconds, so a window of consecutive rows
+is a window of consecutive hours; hours that were never observed are NaN
+rows. Range reads by time are a binary search on time.bin and slice the
+memory maps without parsing anything. Appends skip rows the store already
+has, so re-running an import or appending an overlapping batch is harmless.
+meta.json is replaced atomically after the column files are written, and
+its row count is the only one trusted, so an interrupted append leaves the
+store as it was.
+
+    python data_processing/store.py import combined_electricity_data_hourly.csv history/NYC
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_PATH = os.path.join(DATA_DIR, "history", "NYC")
+
+COLUMNS = ("price", "emission")
+HOUR = 3600
+
+
+class HistoryStore:
+    """
+    Append-only columnar time series on disk.
+
+    Args:
+        path: The store's directory, created if it doesn't exist.
+        columns: Value columns of a new store (an existing store keeps its own).
+        step: Spacing of the time grid in seconds.
+    """
+
+    def __init__(self, path: str = HISTORY_PATH, columns=COLUMNS, step: int = HOUR, dtype: str = "float64"):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self.refresh()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = {"columns": list(columns), "dtype": dtype, "step": step, "rows": 0}
+            for name in ["time"] + self.meta["columns"]:
+                open(self._file(name), "ab").close()
+            self._write_meta()
+
+    def refresh(self) -> None:
+        """Re-reads meta.json, to see rows appended by another process."""
+        with open(os.path.join(self.path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+    @property
+    def columns(self) -> list:
+        return self.meta["columns"]
+
+    def __len__(self) -> int:
+        return self.meta["rows"]
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.bin")
+
+    def _write_meta(self) -> None:
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    def _map(self, name: str) -> np.ndarray:
+        """Read-only memory map of the first len(self) values of a column."""
+        dtype = np.int64 if name == "time" else np.dtype(self.meta["dtype"])
+        if len(self) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=(len(self),))
+
+    # ---------------------------
+    # Reads
+    # ---------------------------
+
+    def times(self) -> np.ndarray:
+        """All row times as datetime64[s]."""
+        return self._map("time").view("datetime64[s]")
+
+    def last_time(self):
+        """Time of the last row as datetime64[s], or None for an empty store."""
+        return self.times()[-1] if len(self) else None
+
+    def rows(self, start=None, end=None) -> slice:
+        """Row range covering start <= time < end (either bound may be None), by binary search."""
+        times = self._map("time")
+        first = 0 if start is None else int(np.searchsorted(times, _seconds(start), side="left"))
+        last = len(times) if end is None else int(np.searchsorted(times, _seconds(end), side="left"))
+        return slice(first, max(first, last))
+
+    def column(self, name: str, start=None, end=None) -> np.ndarray:
+        """A column's values for start <= time < end, as a read-only view of the memory map."""
+        if name not in self.columns:
+            raise KeyError(f"Unknown column: {name}")
+        return self._map(name)[self.rows(start, end)]
+
+    def read(self, start=None, end=None, columns=None, dtype=np.float32):
+        """
+        Reads a time range as a dense array.
+
+        Args:
+            start: First time to include (datetime, datetime64 or ISO string), None for the beginning.
+            end: First time to exclude, None for the end.
+            columns: Columns to read, in order (default all).
+            dtype: dtype of the returned values.
+
+        Returns:
+            (times, values): datetime64[s] array of shape (n,) and values of shape (n, len(columns))
+        """
+        columns = columns or self.columns
+        rows = self.rows(start, end)
+        values = np.empty((rows.stop - rows.start, len(columns)), dtype=dtype)
+        for i, name in enumerate(columns):
+            values[:, i] = self.column(name)[rows]
+        return np.array(self.times()[rows]), values
+
+    def tail(self, n: int, columns=None, dtype=np.float32):
+        """Reads the last n rows, like read()."""
+        if len(self) == 0:
+            return self.read(columns=columns, dtype=dtype)
+        start = self.times()[max(0, len(self) - n)]
+        return self.read(start=start, columns=columns, dtype=dtype)
+
+    # ---------------------------
+    # Appends
+    # ---------------------------
+
+    def append(self, times, **values) -> int:
+        """
+        Appends rows newer than the last one in the store.
+
+        Rows at or before the last stored time are skipped, and hours missing
+        between the stored and the new rows are filled with NaN. Missing
+        values (NaN or None) are kept as NaN.
+
+        Args:
+            times: Row times (datetimes, datetime64 or ISO strings) on the store's time grid.
+            **values: One sequence per column, aligned with `times`.
+
+        Returns:
+            The number of rows written, gap rows included.
+        """
+        if set(values) != set(self.columns):
+            raise ValueError(f"Expected values for columns {self.columns}, got {sorted(values)}")
+        seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+        values = {name: np.asarray(values[name], dtype=float) for name in self.columns}
+        if any(len(column) != len(seconds) for column in values.values()):
+            raise ValueError("Every column needs one value per time")
+        if len(seconds) == 0:
+            return 0
+
+        with self._lock:
+            self.refresh()
+            step = self.meta["step"]
+            # Last value wins for duplicate times within the batch
+            order = np.argsort(seconds, kind="stable")
+            seconds = seconds[order]
+            keep = np.append(seconds[1:] != seconds[:-1], True)
+            seconds = seconds[keep]
+            values = {name: column[order][keep] for name, column in values.items()}
+
+            if len(self):
+                origin = int(self._map("time")[-1])
+                new = seconds > origin
+                seconds = seconds[new]
+                values = {name: column[new] for name, column in values.items()}
+                first = origin + step
+            else:
+                origin = first = int(seconds[0])
+            if len(seconds) == 0:
+                return 0
+            if np.any((seconds - origin) % step):
+                raise ValueError(f"Times must lie on the store's {step} s grid")
+
+            # Dense grid from the first new row to the last, NaN where nothing was observed
+            grid = np.arange(first, int(seconds[-1]) + step, step, dtype=np.int64)
+            positions = (seconds - first) // step
+            rows = len(self)
+            for name in ["time"] + self.columns:
+                if name == "time":
+                    column = grid
+                else:
+                    column = np.full(len(grid), np.nan, dtype=self.meta["dtype"])
+                    column[positions] = values[name]
+                self._write_rows(name, rows, column)
+
+            self.meta["rows"] = rows + len(grid)
+            self._write_meta()
+            return len(grid)
+
+    def _write_rows(self, name: str, rows: int, column: np.ndarray) -> None:
+        """Writes `column` after the first `rows` values, dropping anything left by an interrupted append."""
+        with open(self._file(name), "r+b") as f:
+            f.seek(rows * column.itemsize)
+            f.write(column.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _seconds(stamp) -> int:
+    return int(np.datetime64(stamp, "s").astype(np.int64))
+
+
+def import_csv(csv_path: str, store_path: str = HISTORY_PATH) -> int:
+    """Appends an hourly [time, price, emission] CSV (the old training data format) to a store."""
+    import pandas as pd
+
+    df = pd.read_csv(csv_path, parse_dates=["time"])
+    return HistoryStore(store_path).append(
+        df["time"].to_numpy(), price=df["price"].to_numpy(), emission=df["emission"].to_numpy()
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage an hourly history store.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_command = commands.add_parser("import", help="append a [time, price, emission] CSV")
+    import_command.add_argument("csv_path")
+    import_command.add_argument("store_path", nargs="?", default=HISTORY_PATH)
+    info_command = commands.add_parser("info", help="print the store's size and time range")
+    info_command.add_argument("store_path", nargs="?", default=HISTORY_PATH)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        print(f"Appended {import_csv(args.csv_path, args.store_path)} rows to {args.store_path}")
+    else:
+        store = HistoryStore(args.store_path)
+        times = store.times()
+        print(json.dumps({
+            "path": store.path,
+            "columns": store.columns,
+            "rows": len(store),
+            "first": str(times[0]) if len(times) else None,
+            "last": str(times[-1]) if len(times) else None,
+        }))
@@ -1,46 +1,68 @@
 
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
+import asyncio
 import datetime
+import importlib.util
 import os
-from tensorflow.keras.models import load_model
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import LSTM, Dense, RepeatVector, TimeDistributed
-from tensorflow.keras.optimizers import Adam
+import threading
+
+# TensorFlow, pandas and matplotlib take seconds to import, so they are only
+# imported by the code that uses them. Without TensorFlow, forecasts run on
+# the NumPy backend.
+TENSORFLOW_AVAILABLE = importlib.util.find_spec("tensorflow") is not None
+
+try:
+    from data_processing.numpy_lstm import NumpyLSTMForecaster, NPZ_PATH
+    from data_processing.store import HistoryStore, HISTORY_PATH
+except ImportError:  # run as a script from data_processing/
+    from numpy_lstm import NumpyLSTMForecaster, NPZ_PATH
+    from store import HistoryStore, HISTORY_PATH
 
 # ---------------------------
 # 1) Model Training Function
 # ---------------------------
 
 def train_lstm_model(
-    csv_file_path: str,
+    store_path: str = HISTORY_PATH,
     history_length: int = 24,
     forecast_horizon: int = 24,
     feature_cols = ["price", "emission"],
     epochs: int = 10,
-    batch_size: int = 32
+    batch_size: int = 32,
+    normalize: bool = False
 ):
     """
-    Trains a seq2seq LSTM model on the given CSV file data.
+    Trains a seq2seq LSTM model on the history in the given HistoryStore.
     Returns the trained Keras model.
+
+    Windows are streamed to Keras in batches from a strided view of the data,
+    so memory use doesn't grow with history_length + forecast_horizon. With
+    normalize=True the model trains on standardized features; the scaling is
+    folded into the weights afterwards, so the returned model still takes and
+    returns raw prices and emissions.
     """
-    # 1.1) Read data
-    df = pd.read_csv(csv_file_path, parse_dates=["time"])
-    df = df.sort_values("time").reset_index(drop=True)
+    import matplotlib.pyplot as plt
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import LSTM, Dense, RepeatVector, TimeDistributed
+    from tensorflow.keras.optimizers import Adam
+
+    # 1.1) Read the feature columns; the store is sorted by time, with NaN rows for missing hours
+    _, data = HistoryStore(store_path).read(columns=feature_cols)  # shape: (N, 2) -> columns: [price, emission]
 
-    # 1.2) Extract relevant columns
-    data = df[feature_cols].values  # shape: (N, 2) -> columns: [price, emission]
+    # 1.2) Train/Validation Split over window start indices; no window is materialized here
+    train_idx, val_idx = split_windows(data, history_length, forecast_horizon, val_fraction=0.2)
 
-    # 1.3) Create sequences (sliding windows)
-    X, Y = create_sequences(data, history_length, forecast_horizon)
+    # 1.3) Normalization statistics from the training rows only
+    mean, std = None, None
+    if normalize:
+        train_rows = data[:train_idx[-1] + history_length + forecast_horizon]
+        mean, std = np.nanmean(train_rows, axis=0), np.nanstd(train_rows, axis=0)
 
-    # 1.4) Train/Validation Split
-    train_size = int(0.8 * len(X))
-    X_train, Y_train = X[:train_size], Y[:train_size]
-    X_val,   Y_val   = X[train_size:], Y[train_size:]
+    def dataset(indices, shuffle):
+        return make_dataset(data, indices, history_length, forecast_horizon, batch_size,
+                            mean=mean, std=std, shuffle=shuffle)
 
-    # 1.5) Build Model
+    # 1.4) Build Model
     model = Sequential()
     # Encoder
     model.add(LSTM(64, activation='relu', input_shape=(history_length, len(feature_cols))))
@@ -54,14 +76,15 @@ def train_lstm_model(
     model.compile(optimizer=Adam(learning_rate=0.001), loss='mse')
     model.summary()
 
-    # 1.6) Train
+    # 1.5) Train
     history = model.fit(
-        X_train, Y_train,
+        dataset(train_idx, shuffle=True),
         epochs=epochs,
-        batch_size=batch_size,
-        validation_data=(X_val, Y_val),
+        validation_data=dataset(val_idx, shuffle=False),
         verbose=1
     )
+    if normalize:
+        fold_normalization(model, mean, std)
 
     # Optional: plot training history
     plt.figure()
@@ -81,90 +104,302 @@ def create_sequences(data: np.ndarray, history=24, forecast=24):
     returns:
       X: (samples, history, num_features)
       Y: (samples, forecast, num_features)
+
+    X and Y are read-only strided views into `data`: no window is copied, so
+    they cost no memory beyond `data` itself whatever history and forecast are.
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(data, history + forecast, axis=0)
+    windows = windows.swapaxes(1, 2)  # (samples, history + forecast, num_features)
+    return windows[:, :history], windows[:, history:]
+
+def valid_window_starts(data: np.ndarray, history=24, forecast=24) -> np.ndarray:
+    """Returns the start index of every window of `data` that contains no NaN."""
+    length = history + forecast
+    # Number of rows with a NaN before each row, so each window is checked in O(1)
+    nan_rows = np.concatenate([[0], np.cumsum(np.isnan(data).any(axis=1))])
+    starts = np.arange(len(data) - length + 1)
+    return starts[nan_rows[starts + length] == nan_rows[starts]]
+
+def split_windows(data: np.ndarray, history=24, forecast=24, val_fraction=0.2):
+    """
+    Splits the valid window start indices chronologically into (train, validation).
+
+    Validation windows start only after the last training window's targets
+    end, so no row is seen both in training and in validation.
+    """
+    starts = valid_window_starts(data, history, forecast)
+    train = starts[:int((1 - val_fraction) * len(starts))]
+    if len(train) == 0:
+        raise ValueError(
+            f"Not enough history: {len(starts)} complete windows of {history + forecast} hours, "
+            "none left for training"
+        )
+    val = starts[starts >= train[-1] + history + forecast]
+    return train, val
+
+def window_batches(data: np.ndarray, indices: np.ndarray, history=24, forecast=24, batch_size=32,
+                   mean=None, std=None, shuffle=False, seed=None):
+    """
+    Yields (X, Y) batches for the windows starting at `indices`.
+
+    Only one batch of windows is copied out of the strided view at a time.
+    If `mean` and `std` are given, both inputs and targets are standardized.
     """
-    X, Y = [], []
-    for i in range(len(data) - history - forecast + 1):
-        X.append(data[i : i + history])
-        Y.append(data[i + history : i + history + forecast])
-    return np.array(X), np.array(Y)
+    X, Y = create_sequences(data, history, forecast)
+    order = np.random.default_rng(seed).permutation(indices) if shuffle else indices
+    for start in range(0, len(order), batch_size):
+        batch = np.sort(order[start:start + batch_size])
+        x, y = X[batch].astype(np.float32), Y[batch].astype(np.float32)
+        if mean is not None:
+            x, y = (x - mean) / std, (y - mean) / std
+        yield x, y
+
+def make_dataset(data: np.ndarray, indices: np.ndarray, history=24, forecast=24, batch_size=32,
+                 mean=None, std=None, shuffle=False):
+    """Returns a tf.data.Dataset streaming window_batches, re-shuffled on every epoch."""
+    import tensorflow as tf
+
+    signature = (
+        tf.TensorSpec((None, history, data.shape[1]), tf.float32),
+        tf.TensorSpec((None, forecast, data.shape[1]), tf.float32),
+    )
+    return tf.data.Dataset.from_generator(
+        lambda: window_batches(data, indices, history, forecast, batch_size,
+                               mean=mean, std=std, shuffle=shuffle),
+        output_signature=signature,
+    ).prefetch(2)
+
+def fold_normalization(model, mean: np.ndarray, std: np.ndarray) -> None:
+    """
+    Rewrites the weights of a model trained on standardized features so it takes
+    raw inputs and returns raw outputs, without adding layers.
+
+    The encoder sees (x - mean) / std, which is x @ (W / std) + (b - (mean / std) @ W);
+    the dense output y is de-standardized as y * std + mean.
+    """
+    encoder, dense = model.layers[0], model.layers[-1]
+    kernel, recurrent_kernel, bias = encoder.get_weights()
+    encoder.set_weights([kernel / std[:, None], recurrent_kernel, bias - (mean / std) @ kernel])
+    kernel, bias = dense.get_weights()
+    dense.set_weights([kernel * std[None, :], bias * std + mean])
 
 
 # ----------------------------------
 # 2) Prediction (Inference) Function
 # ----------------------------------
 
-# Assume we have a global (or class-level) model.
-# We will set this up after training.
-MODEL = None
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trained_model.h5")
+
+# "keras", "numpy", or "auto" for Keras when TensorFlow is installed and NumPy otherwise
+FORECAST_BACKEND = os.getenv("FORECAST_BACKEND", "auto")
+
+
+class ForecastService:
+    """
+    Keeps the trained forecaster resident in memory.
+
+    The model is loaded once, reloaded automatically when the file on disk
+    changes (e.g. after retraining) and shared by every caller. Predictions
+    are serialized with a lock so the service can be used from any thread.
+
+    The "keras" backend loads `model_path`; the "numpy" backend loads the
+    weights exported to `npz_path` by numpy_lstm.py and needs no TensorFlow.
+    """
+
+    def __init__(self, model_path: str = MODEL_PATH, npz_path: str = NPZ_PATH,
+                 backend: str = FORECAST_BACKEND):
+        if backend == "auto":
+            backend = "keras" if TENSORFLOW_AVAILABLE else "numpy"
+        if backend not in ("keras", "numpy"):
+            raise ValueError(f"Unknown forecast backend: {backend}")
+        self.backend = backend
+        self.model_path = model_path if backend == "keras" else npz_path
+        self._model = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.backend == "keras":
+            from tensorflow.keras.models import load_model
+            return load_model(self.model_path)
+        return NumpyLSTMForecaster(self.model_path)
+
+    def _current_model(self):
+        """Returns the loaded model, (re)loading it if the file changed. Caller holds the lock."""
+        mtime = os.path.getmtime(self.model_path)
+        if self._model is None or mtime != self._mtime:
+            try:
+                model = self._load()
+            except Exception as e:
+                # A half-written file during a swap should not take the bot down
+                if self._model is None:
+                    raise
+                print(f"Could not reload model from {self.model_path}, keeping the previous one: {e}")
+            else:
+                self._model = model
+                self._mtime = mtime
+        return self._model
+
+    def warmup(self) -> None:
+        """Loads the model and runs one dummy prediction so the first user doesn't pay for it."""
+        self.forecast(np.zeros(24), np.zeros(24))
+
+    @staticmethod
+    def make_window(price_vec: np.ndarray, carbon_vec: np.ndarray) -> np.ndarray:
+        """Stacks the past 24 hours of prices and carbon intensities into one (24, 2) model input."""
+        if len(price_vec) != 24 or len(carbon_vec) != 24:
+            raise ValueError("Expecting 24 elements in each vector (past 24 hours).")
+        return np.column_stack((price_vec, carbon_vec))
+
+    def forecast_batch(self, windows: np.ndarray) -> np.ndarray:
+        """
+        Forecasts the next 24 hours for each of a batch of input windows in one model call.
+
+        Args:
+            windows: np.ndarray of shape (batch, 24, 2), columns [price, emission]
+
+        Returns:
+            np.ndarray of shape (batch, 24, 2), columns [price, emission]
+        """
+        with self._lock:
+            model = self._current_model()
+            if self.backend == "keras":
+                # predict_on_batch runs the compiled graph without predict()'s per-call setup
+                return model.predict_on_batch(windows)
+            return model.predict(windows)
+
+    def forecast(self, price_vec: np.ndarray, carbon_vec: np.ndarray) -> np.ndarray:
+        """
+        Forecasts the next 24 hours from the past 24 hours of prices and carbon intensities.
+
+        Returns:
+            np.ndarray of shape (24, 2), columns [price, emission]
+        """
+        # shape (1, 24, 2)
+        input_data = np.expand_dims(self.make_window(price_vec, carbon_vec), axis=0)
+        return self.forecast_batch(input_data)[0]
+
+
+class InferenceBatcher:
+    """
+    Micro-batches forecast requests made concurrently from the event loop.
+
+    A model call costs about the same for one window as for dozens, so
+    requests are collected for up to `max_wait` seconds (or until
+    `max_batch_size` are waiting) and answered by a single forecast_batch
+    call, run off the event loop. Each caller awaits its own row of the result.
+    """
+
+    def __init__(self, service: ForecastService, max_batch_size: int = 64, max_wait: float = 0.005):
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.requests = 0
+        self._pending = []  # (window, future)
+        self._timer = None
+        self._tasks = set()
+
+    def warmup(self) -> None:
+        """Runs one prediction for every padded batch size so no request waits for Keras to trace one."""
+        size = 1
+        while True:
+            self.service.forecast_batch(np.zeros((size, 24, 2)))
+            if size >= self.max_batch_size:
+                break
+            size = min(size * 2, self.max_batch_size)
+
+    async def forecast(self, price_vec: np.ndarray, carbon_vec: np.ndarray) -> np.ndarray:
+        """Like ForecastService.forecast, but shares the model call with concurrent requests."""
+        window = self.service.make_window(price_vec, carbon_vec)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((window, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._dispatch)
+        return await future
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            # The loop only keeps weak references to tasks
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch) -> None:
+        self.batches += 1
+        self.requests += len(batch)
+        windows = np.stack([window for window, _ in batch])
+        # Keras traces the model again for every new batch size, so batches are padded
+        # to a power of two: at most log2(max_batch_size) + 1 shapes are ever traced
+        padded_size = min(self.max_batch_size, 1 << (len(batch) - 1).bit_length())
+        if padded_size > len(batch):
+            windows = np.concatenate([windows, np.repeat(windows[-1:], padded_size - len(batch), axis=0)])
+        try:
+            predictions = await asyncio.get_running_loop().run_in_executor(
+                None, self.service.forecast_batch, windows
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), prediction in zip(batch, predictions):
+            # A caller that was cancelled while waiting no longer wants its row
+            if not future.done():
+                future.set_result(prediction)
+
+
+FORECASTER = ForecastService()
+BATCHER = InferenceBatcher(FORECASTER)
 
 def forecast(
     carbon_intensity_vector: np.ndarray,
     electricity_price_vector: np.ndarray
 ) -> tuple[np.ndarray, float]:
     """
-    Given a datetime `dt` (e.g., 8:31 PM),
-    the past 24 hours of carbon_intensity_vector and electricity_price_vector,
+    Given the past 24 hours of carbon_intensity_vector and electricity_price_vector,
     returns a tuple (predicted_24h, avg_price_over_forecast).
 
     predicted_24h: np.ndarray of shape (24, 2), columns [price, emission]
     avg_price_over_forecast: float (average predicted price over next 24h)
     """
+    prediction_24 = FORECASTER.forecast(electricity_price_vector, carbon_intensity_vector)
 
-    # 2.1) Combine the two input features into shape (1, 24, 2)
-    # The user provides carbon_intensity_vector (24,) and electricity_price_vector (24,)
-    # We'll stack them column-wise.
-    if len(carbon_intensity_vector) != 24 or len(electricity_price_vector) != 24:
-        raise ValueError("Expecting 24 elements in each vector (past 24 hours).")
-
-    # shape (24, 2)
-    past_24_data = np.column_stack((electricity_price_vector, carbon_intensity_vector))
-
-    # shape (1, 24, 2)
-    input_data = np.expand_dims(past_24_data, axis=0)
-
-    # 2.2) Predict with the global model
-    if MODEL is None:
-        raise ValueError("Global MODEL is not initialized. Train or load the model first.")
-
-    prediction = MODEL.predict(input_data)  # shape (1, 24, 2)
-    prediction_24 = prediction[0]          # shape (24, 2)
-
-    # 2.3) Suppose we want to return the average price over next 24 hours
+    # Suppose we want to return the average price over next 24 hours
     prices_24 = prediction_24[:, 0]
     avg_price = float(np.mean(prices_24))
 
     return prediction_24, avg_price
 
 def get_forecasts(electricity_price_vector, carbon_intensity_vector):
-    MODEL_PATH = "data_processing/trained_model.h5"
-    MODEL = load_model(MODEL_PATH)
     print(f"electricity_price_vector: {electricity_price_vector}")
     print(f"carbon_intensity_vector: {carbon_intensity_vector}")
-    past_24_data = np.column_stack((electricity_price_vector[0:24], carbon_intensity_vector))
-    input_data = np.expand_dims(past_24_data, axis=0)
-    prediction = MODEL.predict(input_data)
-    return prediction[0] 
+    return FORECASTER.forecast(electricity_price_vector[0:24], carbon_intensity_vector)
+
 # -----------------------
 # 3) Main (Train & Demo)
 # -----------------------
 
 if __name__ == "__main__":
 
-    MODEL_PATH = "trained_model.h5"
-    if os.path.exists(MODEL_PATH):
-        MODEL = load_model(MODEL_PATH)
-    else:
-        csv_path = "combined_electricity_data_hourly.csv"
+    if not os.path.exists(MODEL_PATH):
         trained_model = train_lstm_model(
-            csv_file_path=csv_path,
+            store_path=HISTORY_PATH,
             history_length=24,
             forecast_horizon=24,
             feature_cols=["price", "emission"],
             epochs=100,
             batch_size=32
         )
-        MODEL = trained_model
-        MODEL.save(MODEL_PATH)
+        trained_model.save(MODEL_PATH)
 
     now = datetime.datetime(2024, 1, 1, 20, 31)
     example_price_vector = np.random.rand(24) * 0.15
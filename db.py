@@ -0,0 +1,336 @@
+# db.py
+import asyncio
+import datetime
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from zones import DEFAULT_ZONE
+
+DATABASE_NAME = "bot_database.db"
+
+CREATE_USERS = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        battery_capacity REAL,
+        charging_rate REAL,
+        departure_time TEXT,
+        zone TEXT NOT NULL DEFAULT '{default_zone}',
+        last_soc REAL,
+        push_plans INTEGER NOT NULL DEFAULT 0,
+        plan_pushed_on TEXT
+    )
+""".format(default_zone=DEFAULT_ZONE)
+
+# Databases created before a column existed get it on startup
+ADD_USER_COLUMNS = {
+    "zone": "ALTER TABLE users ADD COLUMN zone TEXT NOT NULL DEFAULT '{default_zone}'".format(
+        default_zone=DEFAULT_ZONE
+    ),
+    "last_soc": "ALTER TABLE users ADD COLUMN last_soc REAL",
+    "push_plans": "ALTER TABLE users ADD COLUMN push_plans INTEGER NOT NULL DEFAULT 0",
+    "plan_pushed_on": "ALTER TABLE users ADD COLUMN plan_pushed_on TEXT",
+}
+
+CREATE_CONVERSATIONS = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        start_time DATETIME,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )
+"""
+
+CREATE_MESSAGES = """
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER,
+        sender_type TEXT,
+        message_text TEXT,
+        message_time DATETIME,
+        FOREIGN KEY (conversation_id) REFERENCES conversations(conversation_id)
+    )
+"""
+
+# Latest charging plan per user, computed by plans.py for the given forecast hour.
+# Arrays are stored as raw float64 bytes.
+CREATE_PLANS = """
+    CREATE TABLE IF NOT EXISTS plans (
+        user_id INTEGER PRIMARY KEY,
+        zone TEXT,
+        hour DATETIME,
+        produced_at DATETIME,
+        soc REAL,
+        departure DATETIME,
+        battery_capacity REAL,
+        charging_rate REAL,
+        hours_to_charge REAL,
+        feasible INTEGER,
+        cost REAL,
+        emissions REAL,
+        cost_savings REAL,
+        emission_savings REAL,
+        savings BLOB,
+        energy BLOB,
+        power BLOB,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )
+"""
+
+# Statements are kept as constants so sqlite3's per-connection statement cache reuses them
+SELECT_USER = "SELECT battery_capacity, charging_rate, departure_time, zone FROM users WHERE user_id = ?"
+# Registering again (/edit) keeps the user's zone
+UPSERT_USER = """
+    INSERT INTO users (user_id, battery_capacity, charging_rate, departure_time)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        battery_capacity = excluded.battery_capacity,
+        charging_rate = excluded.charging_rate,
+        departure_time = excluded.departure_time
+"""
+SELECT_USER_ZONE = "SELECT zone FROM users WHERE user_id = ?"
+UPDATE_USER_ZONE = "UPDATE users SET zone = ? WHERE user_id = ?"
+SELECT_PLAN_USERS = """
+    SELECT user_id, battery_capacity, charging_rate, departure_time, zone, last_soc, push_plans, plan_pushed_on
+    FROM users WHERE battery_capacity IS NOT NULL
+"""
+UPDATE_LAST_SOC = "UPDATE users SET last_soc = ? WHERE user_id = ?"
+SELECT_PUSH_PLANS = "SELECT push_plans FROM users WHERE user_id = ?"
+UPDATE_PUSH_PLANS = "UPDATE users SET push_plans = ? WHERE user_id = ?"
+UPDATE_PLAN_PUSHED_ON = "UPDATE users SET plan_pushed_on = ? WHERE user_id = ?"
+UPSERT_PLAN = """
+    INSERT OR REPLACE INTO plans (
+        user_id, zone, hour, produced_at, soc, departure, battery_capacity, charging_rate,
+        hours_to_charge, feasible, cost, emissions, cost_savings, emission_savings, savings, energy, power
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SELECT_CONVERSATION = "SELECT conversation_id FROM conversations WHERE user_id = ? ORDER BY start_time DESC LIMIT 1"
+INSERT_CONVERSATION = "INSERT INTO conversations (user_id, start_time) VALUES (?, ?)"
+INSERT_MESSAGE = "INSERT INTO messages (conversation_id, sender_type, message_text, message_time) VALUES (?, ?, ?, ?)"
+
+
+class Database:
+    """
+    SQLite access for the bot.
+
+    Queries run on a small dedicated thread pool so disk I/O never blocks the
+    event loop. Each worker thread keeps one long-lived connection in WAL
+    mode, so readers don't wait for writers and prepared statements stay
+    cached between calls.
+    """
+
+    def __init__(self, path: str = DATABASE_NAME, max_workers: int = 4):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sqlite")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """Returns the calling thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, cached_statements=128,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    async def run(self, query, *args):
+        """Runs `query(connection, *args)` on the database thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: query(self.connection(), *args)
+        )
+
+    def initialize(self) -> None:
+        """Creates the tables if they don't exist yet and migrates older ones."""
+        conn = self.connection()
+        with conn:
+            conn.execute(CREATE_USERS)
+            conn.execute(CREATE_CONVERSATIONS)
+            conn.execute(CREATE_MESSAGES)
+            conn.execute(CREATE_PLANS)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+            for column, statement in ADD_USER_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(statement)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    async def get_user_info(self, user_id):
+        def query(conn):
+            return conn.execute(SELECT_USER, (user_id,)).fetchone()
+        user_info = await self.run(query)
+        if user_info:
+            return {
+                "battery_capacity": user_info[0],
+                "charging_rate": user_info[1],
+                "departure_time": user_info[2],
+                "zone": user_info[3]
+            }
+        return None
+
+    async def store_user_info(self, user_id, battery_capacity, charging_rate, departure_time) -> str:
+        """Creates or updates the user's profile and returns their zone."""
+        def query(conn):
+            with conn:
+                conn.execute(UPSERT_USER, (user_id, battery_capacity, charging_rate, departure_time))
+                return conn.execute(SELECT_USER_ZONE, (user_id,)).fetchone()[0]
+        return await self.run(query)
+
+    async def set_user_zone(self, user_id, zone: str) -> None:
+        def query(conn):
+            with conn:
+                conn.execute(UPDATE_USER_ZONE, (zone, user_id))
+        await self.run(query)
+
+    async def set_last_soc(self, user_id, soc: float) -> None:
+        def query(conn):
+            with conn:
+                conn.execute(UPDATE_LAST_SOC, (soc, user_id))
+        await self.run(query)
+
+    async def get_push_plans(self, user_id) -> bool:
+        def query(conn):
+            return conn.execute(SELECT_PUSH_PLANS, (user_id,)).fetchone()
+        row = await self.run(query)
+        return bool(row and row[0])
+
+    async def set_push_plans(self, user_id, enabled: bool) -> None:
+        def query(conn):
+            with conn:
+                conn.execute(UPDATE_PUSH_PLANS, (int(enabled), user_id))
+        await self.run(query)
+
+    async def set_plan_pushed_on(self, user_id, date: str) -> None:
+        """Records the day (YYYY-MM-DD) the user's plan was last pushed."""
+        def query(conn):
+            with conn:
+                conn.execute(UPDATE_PLAN_PUSHED_ON, (date, user_id))
+        await self.run(query)
+
+    async def get_plan_users(self) -> list:
+        """
+        Returns (user_id, battery_capacity, charging_rate, departure_time, zone, last_soc, push_plans,
+        plan_pushed_on) of every registered user.
+        """
+        def query(conn):
+            return conn.execute(SELECT_PLAN_USERS).fetchall()
+        return await self.run(query)
+
+    async def store_plans(self, rows) -> None:
+        """Replaces the stored plans of the given users in one transaction."""
+        def query(conn):
+            with conn:
+                conn.executemany(UPSERT_PLAN, rows)
+        await self.run(query)
+
+    async def get_user_conversation_id(self, user_id):
+        def query(conn):
+            return conn.execute(SELECT_CONVERSATION, (user_id,)).fetchone()
+        conversation = await self.run(query)
+        return conversation[0] if conversation else None
+
+    async def start_new_conversation(self, user_id):
+        now = datetime.datetime.now()
+        def query(conn):
+            with conn:
+                return conn.execute(INSERT_CONVERSATION, (user_id, now)).lastrowid
+        return await self.run(query)
+
+    async def log_messages(self, rows) -> None:
+        """Inserts many (conversation_id, sender_type, message_text, message_time) rows in one transaction."""
+        def query(conn):
+            with conn:
+                conn.executemany(INSERT_MESSAGE, rows)
+        await self.run(query)
+
+
+class MessageLogWriter:
+    """
+    Write-behind buffer for the messages table.
+
+    log() only appends to an in-memory buffer and returns immediately, so logging
+    never adds latency to a reply. A background task writes the buffer out in one
+    transaction whenever `batch_size` rows are waiting or `flush_interval` seconds
+    have passed, and close() writes whatever is left on shutdown.
+
+    The buffer holds at most `max_buffered` rows. When it is full (the database
+    can't keep up or is unavailable) new rows are dropped rather than blocking
+    the caller or growing without bound; they are counted in `dropped`. A batch
+    that fails to write is dropped as well and counted in `failed`.
+    """
+
+    def __init__(self, db: Database, batch_size: int = 100, flush_interval: float = 1.0,
+                 max_buffered: int = 10000):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.dropped = 0
+        self.failed = 0
+        self._buffer = deque()
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def buffered(self) -> int:
+        """Number of rows waiting to be written."""
+        return len(self._buffer)
+
+    def log(self, conversation_id, sender_type, message_text) -> None:
+        """Queues a message row; must be called from the event loop."""
+        if len(self._buffer) >= self.max_buffered:
+            self.dropped += 1
+            return
+        self._buffer.append((conversation_id, sender_type, message_text, datetime.datetime.now()))
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Writes all buffered rows, `batch_size` rows per transaction."""
+        while self._buffer:
+            rows = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            try:
+                await self.db.log_messages(rows)
+            except Exception as e:
+                self.failed += len(rows)
+                print(f"Could not write {len(rows)} messages to the database: {e}")
+
+    async def close(self) -> None:
+        """Stops the background task and writes out everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+DB = Database()
+MESSAGE_LOG = MessageLogWriter(DB)
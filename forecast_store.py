@@ -0,0 +1,187 @@
+# forecast_store.py
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from data_processing.training import ForecastService, InferenceBatcher
+from data_processing.retrain import append_observations
+from retrieve_data import get_observed_data, PUBLISH_DELAY
+from metrics import METRICS, span
+from zones import ZONES, DEFAULT_ZONE, ensure_runtime_data
+
+# The hourly job runs once the first NYISO interval of the new hour has been published
+FORECAST_JOB_OFFSET = PUBLISH_DELAY + timedelta(seconds=30)
+
+
+@dataclass
+class ForecastRecord:
+    """A 24h forecast for one zone and hour, together with the inputs it was produced from."""
+    zone: str
+    hour: datetime
+    forecast: np.ndarray  # shape (24, 2), columns [price, emission]
+    produced_at: datetime
+    electricity_price_vector: np.ndarray
+    carbon_intensity_vector: np.ndarray
+    observed_until: datetime  # the price vector covers the 24 hours before this hour
+    carbon_times: list  # hour of each value of carbon_intensity_vector
+
+
+def hour_bucket(now: datetime) -> datetime:
+    """Returns the start of the hour `now` falls in."""
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+# One forecaster and batcher per model artifact; zones sharing a model share its batches
+_FORECASTERS = {}
+_forecasters_lock = threading.Lock()
+
+def forecaster_for(zone: str) -> tuple:
+    """Returns the (ForecastService, InferenceBatcher) serving a zone's model."""
+    zone = ensure_runtime_data(zone)
+    key = (zone.model_path, zone.npz_path)
+    with _forecasters_lock:
+        if key not in _FORECASTERS:
+            service = ForecastService(zone.model_path, zone.npz_path)
+            _FORECASTERS[key] = (service, InferenceBatcher(service))
+        return _FORECASTERS[key]
+
+
+class ForecastStore:
+    """
+    Forecasts keyed by (zone, hour bucket).
+
+    Within an hour every user gets the same forecast, so it is produced once
+    (ahead of time by the hourly job, or by the first request that finds the
+    store empty) and then read by everybody. The last `max_records` records
+    are kept so a forecast can be audited after the fact.
+    """
+
+    def __init__(self, max_records: int = 48):
+        self.max_records = max_records
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}  # (zone, hour) -> task computing that record on the event loop
+
+    def get(self, zone: str, hour: datetime):
+        """Returns the ForecastRecord for `zone` and `hour`, or None."""
+        return self._records.get((zone, hour))
+
+    def put(self, record: ForecastRecord) -> None:
+        with self._lock:
+            key = (record.zone, record.hour)
+            self._records[key] = record
+            self._records.move_to_end(key)
+            while len(self._records) > self.max_records:
+                self._records.popitem(last=False)
+
+    def history(self, zone: str) -> list:
+        """Returns the stored records for `zone`, oldest first."""
+        return [record for record in list(self._records.values()) if record.zone == zone]
+
+    async def acompute(self, emission_api_token, zone: str = DEFAULT_ZONE) -> ForecastRecord:
+        """
+        Produces and stores the forecast for the current hour from the zone's latest market data.
+
+        The market data is fetched off the event loop and the model call goes
+        through the zone's InferenceBatcher, so forecasts computed at the same
+        time (e.g. for several zones) share one batched prediction.
+        """
+        _, batcher = forecaster_for(zone)
+        loop = asyncio.get_running_loop()
+        with span("market_data"):
+            carbon_intensity_vector, electricity_price_vector, observed_until, carbon_times = (
+                await loop.run_in_executor(None, get_observed_data, emission_api_token, zone)
+            )
+        with span("model"):
+            forecasted_24 = await batcher.forecast(electricity_price_vector[0:24], carbon_intensity_vector)
+        return self._store(zone, forecasted_24, electricity_price_vector, carbon_intensity_vector,
+                           observed_until, carbon_times)
+
+    def _store(self, zone, forecasted_24, electricity_price_vector, carbon_intensity_vector,
+               observed_until, carbon_times) -> ForecastRecord:
+        forecasted_24.setflags(write=False)
+        now = datetime.now()
+        record = ForecastRecord(
+            zone=zone,
+            hour=hour_bucket(now),
+            forecast=forecasted_24,
+            produced_at=now,
+            electricity_price_vector=electricity_price_vector,
+            carbon_intensity_vector=carbon_intensity_vector,
+            observed_until=observed_until,
+            carbon_times=carbon_times,
+        )
+        self.put(record)
+        return record
+
+    async def aget_or_compute(self, emission_api_token, zone: str = DEFAULT_ZONE) -> ForecastRecord:
+        """
+        Returns the current hour's record, computing it only if the store doesn't have it yet.
+
+        Concurrent misses wait for a single acompute.
+        """
+        key = (zone, hour_bucket(datetime.now()))
+        record = self.get(*key)
+        if record is not None:
+            return record
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.acompute(emission_api_token, zone))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # A caller that gives up must not cancel the computation the others are waiting for
+        return await asyncio.shield(task)
+
+
+FORECASTS = ForecastStore()
+
+async def aget_hourly_forecast(emission_api_token, zone: str = DEFAULT_ZONE) -> np.ndarray:
+    """Returns the shared (24, 2) forecast for the current hour, computing it if it is missing."""
+    record = FORECASTS.get(zone, hour_bucket(datetime.now()))
+    METRICS.inc("evbot_cache_requests_total", cache="forecast", result="miss" if record is None else "hit")
+    if record is None:
+        record = await FORECASTS.aget_or_compute(emission_api_token, zone)
+    return record.forecast
+
+async def refresh_forecast_job(context) -> None:
+    """JobQueue callback that fills the store for every zone at the top of every hour."""
+    emission_api_token = context.job.data
+    # Computed together, so zones sharing a model share one batched prediction
+    results = await asyncio.gather(
+        *(FORECASTS.acompute(emission_api_token, zone) for zone in ZONES), return_exceptions=True
+    )
+    loop = asyncio.get_running_loop()
+    for zone, result in zip(ZONES, results):
+        if isinstance(result, Exception):
+            METRICS.inc("evbot_job_failures_total", job="hourly-forecast")
+            print(f"Hourly forecast refresh failed for {zone}: {result}")
+            continue
+        # The hours just observed become training data for the daily fine-tuning. They are
+        # placed by the hours the market data was observed in, which lag result.hour when
+        # the forecast was made from a stale snapshot
+        try:
+            await loop.run_in_executor(
+                None, append_observations, zone, result.observed_until,
+                result.electricity_price_vector, result.carbon_intensity_vector, result.carbon_times
+            )
+        except Exception as e:
+            METRICS.inc("evbot_job_failures_total", job="append-observations")
+            print(f"Could not record observations for {zone}: {e}")
+
+def schedule_hourly_forecasts(job_queue, emission_api_token) -> None:
+    """Schedules refresh_forecast_job right after every hour boundary, starting now."""
+    now = datetime.now()
+    next_run = hour_bucket(now) + timedelta(hours=1) + FORECAST_JOB_OFFSET
+    job_queue.run_once(refresh_forecast_job, when=0, data=emission_api_token)
+    job_queue.run_repeating(
+        refresh_forecast_job,
+        interval=timedelta(hours=1),
+        first=next_run - now,
+        data=emission_api_token,
+        name="hourly-forecast",
+    )
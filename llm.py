@@ -1,39 +1,176 @@
 # llm.py
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, AnyMessage
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import START, MessagesState, StateGraph
-import datetime
-import sqlite3
-from reg import DATABASE_NAME, get_user_conversation_id, start_new_conversation # Import database name and conversation functions
+from langgraph.graph import START, StateGraph
+from langgraph.graph.message import add_messages
+from typing import Annotated, TypedDict
+from collections import OrderedDict
+import asyncio
+import os
+import random
+import threading
+import time
+from db import MESSAGE_LOG
+from metrics import METRICS, span
+from reg import get_user_conversation_id, start_new_conversation # Import conversation functions
+
+# Messages kept per conversation thread and conversation threads kept in memory
+MAX_HISTORY_MESSAGES = 20
+MAX_THREADS = 1000
+
+# Limits for calls to the model: seconds per attempt, calls in flight, retries after a failure
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("MAX_CONCURRENT_LLM_CALLS", "8"))
+LLM_RETRIES = 2
+LLM_BACKOFF = 0.5
+
+
+class StubLLM:
+    """
+    Offline stand-in for the Gemini chat model, for load tests.
+
+    Answers every call after `latency` seconds with `reply`, which is either a
+    string or a function taking the list of messages and returning a string.
+    """
+
+    def __init__(self, reply="OK", latency: float = 0.5):
+        self.reply = reply
+        self.latency = latency
+
+    def _answer(self, messages) -> AIMessage:
+        return AIMessage(self.reply(messages) if callable(self.reply) else self.reply)
+
+    def invoke(self, messages):
+        time.sleep(self.latency)
+        return self._answer(messages)
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.latency)
+        return self._answer(messages)
+
 
 # --- Initialize LLM and Langchain Graph ---
-llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp")
+# The Gemini client is built on first use, so importing this module stays cheap
+llm = None
+
+def get_llm():
+    """Returns the chat model, creating the Gemini client (or StubLLM) on first use."""
+    global llm
+    if llm is None:
+        if os.getenv("LLM_BACKEND") == "stub":
+            llm = StubLLM()
+        else:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash-exp")
+    return llm
 
-workflow = StateGraph(state_schema=MessagesState)
+def set_llm(model) -> None:
+    """Replaces the chat model used for every call, e.g. with a StubLLM."""
+    global llm
+    llm = model
 
-def call_model(state: MessagesState):
-    response = llm.invoke(state["messages"])
+llm_slots = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+
+async def invoke_llm(messages):
+    """
+    Calls the chat model without blocking the event loop.
+
+    At most MAX_CONCURRENT_LLM_CALLS calls are in flight at once, each attempt
+    is cut off after LLM_TIMEOUT seconds, and failed attempts are retried up to
+    LLM_RETRIES times with jittered exponential backoff.
+    """
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            async with llm_slots:
+                with span("llm"):
+                    return await asyncio.wait_for(get_llm().ainvoke(messages), timeout=LLM_TIMEOUT)
+        except Exception as e:
+            METRICS.inc("evbot_upstream_errors_total", source="llm")
+            if attempt == LLM_RETRIES:
+                raise
+            delay = LLM_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"LLM call failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def add_messages_windowed(left, right):
+    """
+    Like add_messages, but only keeps the most recent MAX_HISTORY_MESSAGES.
+
+    The window is cut at the first HumanMessage inside it, so the history
+    never opens with a reply whose question was dropped.
+    """
+    messages = add_messages(left, right)
+    cut = max(0, len(messages) - MAX_HISTORY_MESSAGES)
+    while cut < len(messages) and not isinstance(messages[cut], HumanMessage):
+        cut += 1
+    return messages[cut:]
+
+class WindowedMessagesState(TypedDict):
+    messages: Annotated[list[AnyMessage], add_messages_windowed]
+
+
+class BoundedMemorySaver(MemorySaver):
+    """
+    MemorySaver that only keeps the latest checkpoint of each thread and at most
+    `max_threads` threads, evicting the least recently used one first.
+    """
+
+    def __init__(self, max_threads: int = MAX_THREADS):
+        super().__init__()
+        self.max_threads = max_threads
+        self._last_used = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _touch(self, thread_id):
+        with self._lock:
+            self._last_used[thread_id] = None
+            self._last_used.move_to_end(thread_id)
+            while len(self._last_used) > self.max_threads:
+                evicted, _ = self._last_used.popitem(last=False)
+                self.storage.pop(evicted, None)
+
+    def get_tuple(self, config):
+        self._touch(config["configurable"]["thread_id"])
+        return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata):
+        thread_id = config["configurable"]["thread_id"]
+        saved_config = super().put(config, checkpoint, metadata)
+        with self._lock:
+            # Only the latest checkpoint is ever read back, older ones are dead weight
+            checkpoints = self.storage[thread_id]
+            for ts in sorted(checkpoints)[:-1]:
+                del checkpoints[ts]
+        self._touch(thread_id)
+        return saved_config
+
+    def memory_usage(self) -> dict:
+        """Returns the number of threads held and the size of their serialized checkpoints in bytes."""
+        with self._lock:
+            size = sum(
+                len(checkpoint) + len(metadata)
+                for checkpoints in list(self.storage.values())
+                for checkpoint, metadata in list(checkpoints.values())
+            )
+            return {"threads": len(self.storage), "bytes": size}
+
+
+workflow = StateGraph(state_schema=WindowedMessagesState)
+
+async def call_model(state: WindowedMessagesState):
+    response = await invoke_llm(state["messages"])
     return {"messages": response}
 
 workflow.add_edge(START, "model")
 workflow.add_node("model", call_model)
 
-memory = MemorySaver()
+memory = BoundedMemorySaver()
 app_langchain = workflow.compile(checkpointer=memory)
 
 
 async def log_message_to_db(conversation_id, sender_type, message_text):
-    """Logs a message to the messages table in the database."""
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    now = datetime.datetime.now()
-    cursor.execute(
-        "INSERT INTO messages (conversation_id, sender_type, message_text, message_time) VALUES (?, ?, ?, ?)",
-        (conversation_id, sender_type, message_text, now)
-    )
-    conn.commit()
-    conn.close()
+    """Queues a message for the messages table; it is written in the background in batches."""
+    MESSAGE_LOG.log(conversation_id, sender_type, message_text)
 
 
 async def get_llm_response(user_input: str, user_id: str) -> str:
@@ -55,10 +192,37 @@ async def get_llm_response(user_input: str, user_id: str) -> str:
 
     config = {"configurable": {"thread_id": str(user_id)}} # Thread ID for memory
     input_messages = [HumanMessage(user_input)]
-    output = app_langchain.invoke({"messages": input_messages}, config)
+    output = await app_langchain.ainvoke({"messages": input_messages}, config)
     llm_response_message = output["messages"][-1]
     llm_response_text = llm_response_message.content
 
     await log_message_to_db(conversation_id, 'llm', llm_response_text) # Log LLM response
 
-    return llm_response_text
\ No newline at end of file
+    return llm_response_text
+
+
+async def get_llm_extraction(prompt: str) -> str:
+    """
+    Gets a one-off LLM response for an extraction prompt.
+
+    Extraction prompts are self-contained, so they skip the conversation memory
+    entirely; they are logged under the "system" conversation like before.
+
+    Args:
+        prompt: The full extraction prompt.
+
+    Returns:
+        The LLM's text response.
+    """
+    conversation_id = await get_user_conversation_id("system")
+    if not conversation_id:
+        conversation_id = await start_new_conversation("system")
+
+    await log_message_to_db(conversation_id, 'user', prompt)
+
+    response = await invoke_llm([HumanMessage(prompt)])
+    llm_response_text = response.content
+
+    await log_message_to_db(conversation_id, 'llm', llm_response_text)
+
+    return llm_response_text
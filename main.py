@@ -1,26 +1,84 @@
 # main.py
+import asyncio
 import os
-from dotenv import load_dotenv
-load_dotenv()
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+import sys
+import threading
+from contextlib import asynccontextmanager
+from functools import wraps
+from urllib.parse import urlparse
+from metrics import (
+    METRICS, METRICS_PORT, METRICS_LOG_INTERVAL, STARTUP, traced, span, set_outcome,
+    start_metrics_server, schedule_metrics_log
+)
+
+# Heavy subsystems (TensorFlow, LangChain/Gemini) are not imported here; they
+# are loaded by prewarm() in the background once the bot is polling.
+with STARTUP.phase("import dotenv"):
+    from dotenv import load_dotenv
+    load_dotenv()
+with STARTUP.phase("import telegram"):
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 from datetime import datetime, timedelta
-from data_processing.training import get_forecasts
+with STARTUP.phase("import data_processing.training"):
+    from data_processing.training import TENSORFLOW_AVAILABLE
+    from data_processing.retrain import schedule_daily_retrain
 
-from reg import (
-    start, edit, handle_registration_response, is_registration_ongoing,
-    get_user_data_db, process_charging_input, get_user_info, send_welcome_back_message,
-    is_user_registered
-)
-from llm import get_llm_response
-from pred import pred
+with STARTUP.phase("import reg, db"):
+    from reg import (
+        start, edit, zone, plans, set_last_soc, handle_registration_response, is_registration_ongoing,
+        get_user_data_db, process_charging_input, get_user_info, send_welcome_back_message,
+        get_user_profile, initialize_database, PARSE_STATS, PROFILES
+    )
+    from db import MESSAGE_LOG
+with STARTUP.phase("import pred, scheduler"):
+    from pred import pred
+    from scheduler import optimal_schedule
+
+with STARTUP.phase("import retrieve_data, forecast_store"):
+    from retrieve_data import market_data
+    from zones import ZONES, DEFAULT_ZONE, ensure_runtime_data
+    from forecast_store import aget_hourly_forecast, forecaster_for, schedule_hourly_forecasts
+    from plans import PLANS, schedule_plans
 
-from retrieve_data import get_data
+# "polling" (default) or "webhook": Telegram pushes updates to WEBHOOK_URL, served on WEBHOOK_LISTEN:WEBHOOK_PORT
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Updates handled at the same time; one user's updates still run one after another
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
 
-def format_forecast_message(forecasts, hours_to_charge) -> str:
+def format_schedule_message(schedule) -> str:
+    """
+    Formats a ChargingSchedule into a readable message.
+    Only the hours in which the car should charge are listed.
+    """
+    message = "Recommended charging schedule:\n\n"
+    message += "```\nHour        Rate      Energy\n"
+    message += "------------------------------\n"
+
+    current_time = datetime.now()
+    for i, (power, energy) in enumerate(zip(schedule.power, schedule.energy)):
+        if energy <= 0:
+            continue
+        time_str = (current_time + timedelta(hours=i)).strftime("%I:%M %p")
+        message += f"{time_str}    {power:4.1f} kW   {energy:4.1f} kWh\n"
+
+    message += "```\n"
+    message += (
+        f"Estimated cost ${schedule.cost:.2f} (saves ${schedule.cost_savings:.2f}) and "
+        f"{schedule.emissions:.0f} g CO2 (saves {schedule.emission_savings:.0f} g) "
+        "compared to charging right away."
+    )
+    return message
+
+def format_forecast_message(forecasts, hours_to_charge, schedule=None) -> str:
     """
     Formats the forecast vectors into a readable message.
     forecasts is a 2*(n-3) vector [cost_reductions, emission_reductions]
+    If a ChargingSchedule is given, the recommended schedule is appended.
     """
     cost_reductions = forecasts[:len(forecasts)//2]
     emission_reductions = forecasts[len(forecasts)//2:]
@@ -45,16 +103,24 @@ def format_forecast_message(forecasts, hours_to_charge) -> str:
         message += f"{time_str}    ${cost:6.2f}    {emission:6.1f} g\n"
     
     message += "```"
+
+    if schedule is not None:
+        message += "\n\n" + format_schedule_message(schedule)
     return message
 
-async def handle_charging_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@traced("charging")
+async def handle_charging_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                user_info=None) -> None:
     """Handles user input for charging state and departure time."""
     try:
         # Get SoC and departure time from user input
-        soc, departure_time = await process_charging_input(update.message.text)
+        with span("parse"):
+            soc, departure_time = await process_charging_input(update.message.text)
         
         # Get user's default departure time if none provided
-        user_info = await get_user_info(update.effective_user.id)
+        if user_info is None:
+            with span("profile_lookup"):
+                user_info = await get_user_info(update.effective_user.id)
         if departure_time is None:
             departure_time = user_info['departure_time']
         
@@ -72,32 +138,58 @@ async def handle_charging_input(update: Update, context: ContextTypes.DEFAULT_TY
         if dt < current_time:
             dt = dt + timedelta(days=1)
         
-        # Get price and carbon intensity records for the past 24 hours
-        emission_api_token = os.getenv("emission_api_token")
-        carbon_intensity_vector,electricity_price_vector = get_data(emission_api_token)
-        forecasted_24 = get_forecasts(electricity_price_vector, carbon_intensity_vector)
+        # This hour's precomputed plan answers the request if it was made for the same inputs
+        plan = PLANS.lookup(update.effective_user.id, user_info['zone'], soc, dt,
+                            battery_capacity, charging_rate)
+        METRICS.inc("evbot_cache_requests_total", cache="plan", result="miss" if plan is None else "hit")
+        if plan is not None:
+            forecasts, hours_to_charge, schedule = plan.forecasts, plan.hours_to_charge, plan.schedule
+        else:
+            # Get this hour's shared price and emission forecast for the user's zone
+            emission_api_token = os.getenv("emission_api_token")
+            with span("forecast"):
+                forecasted_24 = await aget_hourly_forecast(emission_api_token, user_info['zone'])
+
+            # Get forecasts from prediction function
+            with span("pred"):
+                forecasts, hours_to_charge = pred(soc, dt, battery_capacity, charging_rate, forecasted_24)
 
-        # Get forecasts from prediction function
-        forecasts, hours_to_charge = pred(soc, dt, battery_capacity, charging_rate, forecasted_24)
+            # Cheapest hourly plan, charging only in the best hours before departure
+            with span("schedule"):
+                schedule = optimal_schedule(
+                    forecasted_24,
+                    energy_needed=battery_capacity * (100 - soc) / 100,
+                    max_rate=charging_rate,
+                    hours_until_departure=(dt - datetime.now()).total_seconds() / 3600,
+                )
         
         # Format and send response
-        await update.message.reply_text(
-            f"Current Status:\n"
-            f"• Battery Level: {soc}%\n"
-            f"• Departure Time: {departure_time}\n"
-            f"• Battery Capacity: {battery_capacity} kWh\n"
-            f"• Charging Rate: {charging_rate} kW\n\n"
-            "Analyzing optimal charging times..."
-        )
-        
-        # Send formatted forecast message
-        forecast_message = format_forecast_message(forecasts, hours_to_charge)
-        await update.message.reply_text(
-            forecast_message,
-            parse_mode='Markdown'
-        )
+        with span("reply"):
+            await update.message.reply_text(
+                f"Current Status:\n"
+                f"• Battery Level: {soc}%\n"
+                f"• Departure Time: {departure_time}\n"
+                f"• Battery Capacity: {battery_capacity} kWh\n"
+                f"• Charging Rate: {charging_rate} kW\n\n"
+                "Analyzing optimal charging times..."
+            )
+            
+            # Send formatted forecast message
+            forecast_message = format_forecast_message(forecasts, hours_to_charge, schedule)
+            await update.message.reply_text(
+                forecast_message,
+                parse_mode='Markdown'
+            )
+
+        # The next precomputed plan starts from this state of charge
+        with span("db_write"):
+            try:
+                await set_last_soc(update.effective_user.id, soc)
+            except Exception as e:
+                print(f"Could not save the state of charge of {update.effective_user.id}: {e}")
         
     except Exception as e:
+        set_outcome("error")
         await update.message.reply_text(
             "I couldn't process that input. Please provide the state of charge percentage "
             "and optionally when you'll leave (e.g., 'Battery is at 45% and I'll leave at 9:30 AM' "
@@ -105,6 +197,51 @@ async def handle_charging_input(update: Update, context: ContextTypes.DEFAULT_TY
             f"Error details: {str(e)}"
         )
 
+class UserLocks:
+    """
+    One asyncio.Lock per user, dropped again once nobody holds or waits for it.
+
+    asyncio.Lock wakes waiters first come, first served, so a user's updates
+    are handled in the order they arrived.
+    """
+
+    def __init__(self):
+        self._locks = {}  # user id -> [lock, number of holders and waiters]
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+USER_LOCKS = UserLocks()
+
+def per_user(handler):
+    """
+    Decorator that serializes a handler per user.
+
+    With concurrent updates, two messages from the same user would otherwise
+    interleave and race on context.user_data (e.g. the registration step)
+    and the user's conversation memory; different users still run in parallel.
+    """
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None:
+            return await handler(update, context)
+        async with USER_LOCKS.hold(update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Routes messages to appropriate handlers based on registration status."""
     # First check if registration is ongoing
@@ -113,7 +250,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     # Check if user needs registration
-    if not await is_user_registered(update.effective_user.id):
+    with span("profile_lookup"):
+        registered, user_info = await get_user_profile(update.effective_user.id)
+    if not registered:
         context.user_data['registration_step'] = 'battery_capacity'
         await update.message.reply_html(
             rf"Hi {update.effective_user.mention_html()}! You need to register first.\n\n"
@@ -122,7 +261,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     # Handle charging input
-    await handle_charging_input(update, context)
+    await handle_charging_input(update, context, user_info)
 
 async def debug_get_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Debug command to get user data from db."""
@@ -130,23 +269,137 @@ async def debug_get_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_data = await get_user_data_db(user_id)
     await update.message.reply_text(f"User data from DB: {user_data}")
 
+def conversation_memory_usage() -> dict:
+    """Returns the LLM conversation memory size, without importing llm if nothing has used it yet."""
+    llm = sys.modules.get("llm")
+    if llm is None:
+        return {"threads": 0, "bytes": 0}
+    return llm.memory.memory_usage()
+
+async def debug_get_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Debug command to show LLM usage, conversation memory size and profile cache counters."""
+    total = PARSE_STATS["fast_path"] + PARSE_STATS["llm"]
+    share = PARSE_STATS["fast_path"] / total * 100 if total else 0
+    memory_usage = conversation_memory_usage()
+    await update.message.reply_text(
+        f"Inputs parsed without the LLM: {PARSE_STATS['fast_path']} of {total} ({share:.0f}%)\n"
+        f"Conversation memory: {memory_usage['threads']} threads, {memory_usage['bytes']} bytes\n"
+        f"Profile cache: {PROFILES.hits} hits, {PROFILES.misses} misses"
+    )
+
+def register_gauges() -> None:
+    """Exports the numbers behind /stats as gauges alongside the request metrics."""
+    METRICS.gauge("evbot_conversation_memory_threads", lambda: conversation_memory_usage()["threads"])
+    METRICS.gauge("evbot_conversation_memory_bytes", lambda: conversation_memory_usage()["bytes"])
+    METRICS.gauge("evbot_profile_cache_size", lambda: len(PROFILES))
+    METRICS.gauge("evbot_message_log_buffered", lambda: MESSAGE_LOG.buffered)
+    METRICS.gauge("evbot_message_log_dropped", lambda: MESSAGE_LOG.dropped)
+    METRICS.gauge("evbot_message_log_failed", lambda: MESSAGE_LOG.failed)
+    METRICS.gauge("evbot_inference_batches", lambda: forecaster_for(DEFAULT_ZONE)[1].batches)
+    METRICS.gauge("evbot_inference_requests", lambda: forecaster_for(DEFAULT_ZONE)[1].requests)
+    METRICS.gauge("evbot_users_in_flight", lambda: len(USER_LOCKS))
+    METRICS.gauge("evbot_plans_stored", lambda: len(PLANS))
+
+def prewarm() -> None:
+    """
+    Loads the heavy subsystems so the first users don't pay for them.
+
+    Runs on a background thread while the bot is already polling; a request
+    that needs one of them before it is ready simply loads it itself.
+    """
+    try:
+        with STARTUP.phase("prewarm: llm (LangChain, Gemini client)"):
+            import llm
+            llm.get_llm()
+        with STARTUP.phase("prewarm: forecaster"):
+            for name in ZONES:
+                service, batcher = forecaster_for(name)
+                service.warmup()
+                batcher.warmup()
+    except Exception as e:
+        print(f"Prewarm failed, loading lazily on first use instead: {e}")
+    print(STARTUP.render())
+
+async def post_init(application) -> None:
+    """Initializes what handlers need right away, then prewarms the rest in the background."""
+    with STARTUP.phase("init database"):
+        initialize_database()
+
+    # Copy the committed history and models into RUNTIME_DIR on the first run, then keep
+    # every zone's shared market data snapshot refreshed in the background
+    for name in ZONES:
+        ensure_runtime_data(name)
+        market_data(name).start(os.getenv("emission_api_token"))
+
+    threading.Thread(target=prewarm, name="prewarm", daemon=True).start()
+
+async def flush_message_log(application) -> None:
+    """Writes out the buffered conversation messages when the bot shuts down."""
+    await MESSAGE_LOG.close()
+
 def main() -> None:
     """Run the telegram bot."""
     telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    application = ApplicationBuilder().token(telegram_bot_token).build()
+    emission_api_token = os.getenv("emission_api_token")
+
+    with STARTUP.phase("build application"):
+        application = (
+            ApplicationBuilder()
+            .token(telegram_bot_token)
+            .post_init(post_init)
+            .post_shutdown(flush_message_log)
+            # Bounded, so a burst of updates can't start unlimited LLM and upstream calls
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .build()
+        )
+
+    # Produce the shared forecast ahead of time at the top of every hour
+    schedule_hourly_forecasts(application.job_queue, emission_api_token)
+    # Then plan every registered user from it, and push plans to those who opted in
+    schedule_plans(application.job_queue, emission_api_token, format_forecast_message)
+    # Fine-tune the models on the hours observed since, in a separate process
+    if TENSORFLOW_AVAILABLE:
+        schedule_daily_retrain(application.job_queue)
+
+    # Request metrics: Prometheus endpoint and/or periodic log lines
+    register_gauges()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if METRICS_LOG_INTERVAL:
+        schedule_metrics_log(application.job_queue, METRICS_LOG_INTERVAL)
 
     # Command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("edit", edit))
+    # Every handler that reads or writes a user's state runs under that user's lock
+    application.add_handler(CommandHandler("start", per_user(start)))
+    application.add_handler(CommandHandler("edit", per_user(edit)))
+    application.add_handler(CommandHandler("zone", per_user(zone)))
+    application.add_handler(CommandHandler("plans", per_user(plans)))
     application.add_handler(CommandHandler("getuserdata", debug_get_user_data))
+    application.add_handler(CommandHandler("stats", debug_get_stats))
 
     # Message handler for text messages
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
-        handle_message
+        per_user(handle_message)
     ))
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("BOT_MODE=webhook needs WEBHOOK_URL, the public URL Telegram should post updates to")
+        # Served by PTB's webhook server (python-telegram-bot[webhooks]); the URL path is the one in WEBHOOK_URL
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(CONCURRENT_UPDATES, 100),  # Telegram allows at most 100
+            allowed_updates=Update.ALL_TYPES,
+        )
+    elif BOT_MODE == "polling":
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        raise ValueError(f"Unknown BOT_MODE: {BOT_MODE} (expected polling or webhook)")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
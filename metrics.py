@@ -0,0 +1,311 @@
+# metrics.py
+"""
+Lightweight request tracing and metrics for the bot.
+
+Handlers are wrapped in a trace, and each stage inside them in a span:
+
+    @traced("charging")
+    async def handle_charging_input(update, context):
+        with span("parse"):
+            ...
+
+Span durations go into per-stage latency histograms, and counters record
+cache hits and upstream errors. Whether a request's spans are recorded at all
+is decided once per trace with probability METRICS_SAMPLE_RATE, and a sampled
+trace is also printed to stderr as one JSON log line with probability
+TRACE_LOG_RATE, keeping stdout free for tools that print their own reports.
+
+STARTUP records how long each import and initialization step of the bot
+took, for the report printed once startup has finished.
+
+Everything is exported in the Prometheus text format on
+http://localhost:METRICS_PORT/metrics (when METRICS_PORT is set) and as a
+periodic JSON log line on stderr every METRICS_LOG_INTERVAL seconds (when set).
+"""
+import bisect
+import contextvars
+import http.server
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1.0"))
+TRACE_LOG_RATE = float(os.getenv("TRACE_LOG_RATE", "0.01"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "0"))
+
+# Upper bounds in seconds, from an in-memory cache hit up to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metrics:
+    """
+    Thread-safe counters, histograms and callback gauges, keyed by name and labels.
+
+    Histograms use fixed buckets so an observation is a bisect and three
+    additions; nothing is kept per sample.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._gauges = {}      # name -> function returning the current value
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name: str, func) -> None:
+        """Registers `func()` to be called for the gauge's value whenever metrics are exported."""
+        self._gauges[name] = func
+
+    def _collect(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: [list(h[0]), h[1], h[2]] for key, h in self._histograms.items()}
+        gauges = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                gauges[name] = float(func())
+            except Exception:
+                continue
+        return counters, histograms, gauges
+
+    def quantile(self, counts, total, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile, inf if it is past the last bucket."""
+        rank, seen = q * total, 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        counters, histograms, gauges = self._collect()
+        lines, typed = [], set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for name, value in sorted(gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Returns counters, gauges and count/mean/p95 per histogram, for a structured log line."""
+        counters, histograms, gauges = self._collect()
+        summary = {"counters": {}, "histograms": {}, "gauges": gauges}
+        for (name, labels), value in sorted(counters.items()):
+            summary["counters"][name + _format_labels(labels)] = value
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            summary["histograms"][name + _format_labels(labels)] = {
+                "count": count,
+                "mean_ms": round(total / count * 1000, 3) if count else 0,
+                "p95_le_ms": self.quantile(counts, count, 0.95) * 1000,
+            }
+        return summary
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+METRICS = Metrics()
+
+
+# ---------------------------
+# Traces and spans
+# ---------------------------
+
+class Trace:
+    """The spans recorded while handling one request."""
+
+    __slots__ = ("name", "sampled", "outcome", "spans")
+
+    def __init__(self, name: str, sampled: bool):
+        self.name = name
+        self.sampled = sampled
+        self.outcome = "ok"
+        self.spans = []
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+@contextmanager
+def trace(name: str):
+    """Times one request handled by `name` and collects the spans opened inside it."""
+    current = Trace(name, random.random() < METRICS_SAMPLE_RATE)
+    token = _current_trace.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_trace.reset(token)
+        METRICS.inc("evbot_requests_total", handler=name, outcome=current.outcome)
+        if current.sampled:
+            METRICS.observe("evbot_request_seconds", elapsed, handler=name)
+            if random.random() < TRACE_LOG_RATE:
+                print(json.dumps({
+                    "trace": name,
+                    "outcome": current.outcome,
+                    "total_ms": round(elapsed * 1000, 3),
+                    "spans_ms": [[stage, round(seconds * 1000, 3)] for stage, seconds in current.spans],
+                }), file=sys.stderr)
+
+@contextmanager
+def span(stage: str):
+    """
+    Times one stage of the current request.
+
+    Outside a trace (e.g. in a worker thread) the stage is sampled on its own
+    and only feeds the stage histogram.
+    """
+    current = _current_trace.get()
+    sampled = current.sampled if current is not None else random.random() < METRICS_SAMPLE_RATE
+    if not sampled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        METRICS.observe("evbot_stage_seconds", elapsed, stage=stage)
+        if current is not None:
+            current.spans.append((stage, elapsed))
+
+def set_outcome(outcome: str) -> None:
+    """Marks the current request's outcome, for handlers that answer errors instead of raising."""
+    current = _current_trace.get()
+    if current is not None:
+        current.outcome = outcome
+
+def traced(name: str):
+    """Decorator that runs an async handler inside trace(name)."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with trace(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------------------------
+# Startup report
+# ---------------------------
+
+class StartupReport:
+    """
+    Wall time of each startup phase, measured from when this module was imported.
+
+    Phases may run on different threads (e.g. a background prewarm), so each
+    one records its start offset and the thread it ran on.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # (name, start offset, seconds, thread name)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append((name, start - self.started, end - start,
+                                    threading.current_thread().name))
+            METRICS.observe("evbot_startup_seconds", end - start, phase=name)
+
+    def render(self) -> str:
+        """Returns the phases as a table, in the order they started."""
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        elapsed = time.perf_counter() - self.started
+        lines = [f"Startup report ({elapsed:.2f} s since start):",
+                 f"  {'phase':40s} {'at':>8s} {'took':>8s}  thread"]
+        for name, offset, seconds, thread in phases:
+            lines.append(f"  {name:40s} {offset:7.2f}s {seconds:7.2f}s  {thread}")
+        return "\n".join(lines)
+
+
+STARTUP = StartupReport()
+
+
+# ---------------------------
+# Exporters
+# ---------------------------
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Serves METRICS on http://localhost:port/metrics from a daemon thread."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+async def log_metrics_job(context) -> None:
+    """JobQueue callback that prints the metrics summary as one JSON line on stderr."""
+    print(json.dumps({"metrics": METRICS.summary()}), file=sys.stderr)
+
+def schedule_metrics_log(job_queue, interval: float = METRICS_LOG_INTERVAL) -> None:
+    """Prints the metrics summary every `interval` seconds."""
+    job_queue.run_repeating(log_metrics_job, interval=interval, first=interval, name="metrics-log")
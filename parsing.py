@@ -0,0 +1,184 @@
+# parsing.py
+"""
+Deterministic extraction of battery levels, kWh/kW figures and clock times.
+
+Each parser returns None when it isn't sure, in which case the caller falls
+back to the LLM. Being unsure is always preferred over guessing.
+"""
+import re
+
+# 1,000 and 12,345.6 use commas as thousands separators; in 7,5 the comma is a decimal point
+THOUSANDS = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?(?!\d)"
+NUMBER = r"(" + THOUSANDS + r"|\d+(?:[.,]\d+)?)"
+THOUSANDS_RE = re.compile(THOUSANDS)
+
+PERCENT_RE = re.compile(NUMBER + r"\s*(?:%|percent\b|pct\b)", re.IGNORECASE)
+BARE_NUMBER_RE = re.compile(r"^\s*" + NUMBER + r"\s*$")
+# soc 45, battery at 45, charge level: 45 (but not 45% again, 45 kWh or a time like 7:30)
+SOC_RE = re.compile(
+    r"\b(?:soc|state of charge|battery(?: level)?|charge level)\s*(?:is\s*)?(?:at\s*)?[:=]?\s*" + NUMBER
+    + r"(?!\d|[.,]\d|\s*(?:%|percent\b|pct\b|[:h]\d|kw|[ap]\.?\s*m\b))",
+    re.IGNORECASE,
+)
+KWH_RE = re.compile(NUMBER + r"\s*kw\s*h\b", re.IGNORECASE)
+KW_RE = re.compile(NUMBER + r"\s*kw\b(?!\s*h\b)(?!\s*/\s*h\b)", re.IGNORECASE)
+
+# 7:30am, 7.30 p.m., 7 am, 730pm
+MERIDIEM_TIME_RE = re.compile(
+    r"\b(\d{1,2})(?:[:.h]?(\d{2}))?\s*([ap])\.?\s*m\b\.?", re.IGNORECASE
+)
+# 19:30, 07:30, 7:30, 7h30
+CLOCK_TIME_RE = re.compile(r"\b(\d{1,2})[:h](\d{2})\b", re.IGNORECASE)
+# 8 in the morning, 8:30 tonight
+DAYPART_TIME_RE = re.compile(
+    r"\b(\d{1,2})(?:[:.](\d{2}))?\s*(?:o'?clock\s*)?"
+    r"(in the morning|this morning|tomorrow morning|in the afternoon|in the evening|"
+    r"this evening|at night|tonight)\b",
+    re.IGNORECASE,
+)
+NAMED_TIME_RE = re.compile(r"\b(noon|midday|midnight)\b", re.IGNORECASE)
+# Anything that suggests a time was mentioned, even if we can't read it
+TIME_HINT_RE = re.compile(
+    r"\d\s*[:.h]\s*\d|\d\s*[ap]\.?\s*m\b|o'?clock|\bleav|\bdepart|\bgo(?:ing)? out|"
+    r"\b(?:at|by) \d{1,2}(?![\d.,]*\s*(?:%|percent))|"
+    r"\bmorning\b|\bevening\b|\btonight\b|\bnoon\b|\bmidnight\b|\btomorrow\b",
+    re.IGNORECASE,
+)
+
+PM_DAYPARTS = ("afternoon", "evening", "night", "tonight")
+
+
+def _to_float(value: str) -> float:
+    if THOUSANDS_RE.fullmatch(value):
+        return float(value.replace(",", ""))
+    return float(value.replace(",", "."))
+
+def _format_time(hour: int, minute: int) -> str:
+    """Formats a 24-hour clock time as 'H:MM AM/PM', the format stored for departure times."""
+    suffix = "AM" if hour < 12 else "PM"
+    return f"{hour % 12 or 12}:{minute:02d} {suffix}"
+
+def _single(values):
+    """Returns the only distinct value, or None if there are zero or several."""
+    distinct = set(values)
+    return distinct.pop() if len(distinct) == 1 else None
+
+def parse_percentage(text: str):
+    """Extracts a state of charge in percent, e.g. 'Battery is at 45%' or 'soc 45' -> 45.0."""
+    values = [_to_float(m.group(1)) for m in PERCENT_RE.finditer(text)]
+    values += [_to_float(m.group(1)) for m in SOC_RE.finditer(text)]
+    if not values:
+        bare = BARE_NUMBER_RE.match(text)
+        values = [_to_float(bare.group(1))] if bare else []
+    value = _single(values)
+    if value is None or not 0 <= value <= 100:
+        return None
+    return value
+
+def parse_energy(text: str):
+    """Extracts a battery capacity in kWh, e.g. 'my tesla has a 76.2kwh battery' -> 76.2."""
+    values = [_to_float(m.group(1)) for m in KWH_RE.finditer(text)]
+    if not values and not KW_RE.search(text):
+        bare = BARE_NUMBER_RE.match(text)
+        values = [_to_float(bare.group(1))] if bare else []
+    value = _single(values)
+    return value if value and value > 0 else None
+
+def parse_power(text: str):
+    """Extracts a charging rate in kW, e.g. 'it charges at 7.4kw at home' -> 7.4."""
+    values = [_to_float(m.group(1)) for m in KW_RE.finditer(text)]
+    if not values and not KWH_RE.search(text):
+        bare = BARE_NUMBER_RE.match(text)
+        values = [_to_float(bare.group(1))] if bare else []
+    value = _single(values)
+    return value if value and value > 0 else None
+
+def parse_time(text: str):
+    """
+    Extracts a clock time as 'H:MM AM/PM', e.g. 'i leave at 8:30 in the morning' -> '8:30 AM'.
+
+    Times without AM/PM are only accepted when they are unambiguous (24-hour
+    clock like 19:30 or 07:30, or a part of the day like 'tonight').
+    """
+    found = []
+
+    for m in MERIDIEM_TIME_RE.finditer(text):
+        hour, minute = int(m.group(1)), int(m.group(2) or 0)
+        if not 1 <= hour <= 12 or minute > 59:
+            return None
+        hour = hour % 12 + (12 if m.group(3).lower() == "p" else 0)
+        found.append((hour, minute))
+
+    for m in DAYPART_TIME_RE.finditer(text):
+        hour, minute = int(m.group(1)), int(m.group(2) or 0)
+        if not 1 <= hour <= 12 or minute > 59:
+            return None
+        is_pm = any(part in m.group(3).lower() for part in PM_DAYPARTS)
+        if is_pm and hour == 12 and "night" in m.group(3).lower():
+            hour = 0  # 12 at night is midnight
+        elif is_pm:
+            hour = hour % 12 + 12
+        else:
+            hour = hour % 12
+        found.append((hour, minute))
+
+    if not found:
+        for m in CLOCK_TIME_RE.finditer(text):
+            digits, hour, minute = m.group(1), int(m.group(1)), int(m.group(2))
+            if hour > 23 or minute > 59:
+                return None
+            # 7:30 could be morning or evening; 07:30 and 19:30 can't
+            if hour < 13 and not (len(digits) == 2 and hour < 10) and hour != 0:
+                return None
+            found.append((hour, minute))
+
+    for m in NAMED_TIME_RE.finditer(text):
+        found.append((0, 0) if m.group(1).lower() == "midnight" else (12, 0))
+
+    time = _single(found)
+    return _format_time(*time) if time else None
+
+def parse_charging_input(text: str):
+    """
+    Extracts the state of charge and optional departure time from a charging message.
+
+    Returns:
+        (soc, departure_time) with departure_time None if no time was mentioned,
+        or None if the message can't be read with confidence.
+    """
+    soc = parse_percentage(text)
+    if soc is None:
+        return None
+
+    departure_time = parse_time(text)
+    # A time was mentioned but we couldn't read it
+    if departure_time is None and TIME_HINT_RE.search(text):
+        return None
+    # A number that is neither the battery level nor part of the time, as in '45%, 7'
+    if _leftover_digits(text):
+        return None
+    return soc, departure_time
+
+def _leftover_digits(text: str) -> bool:
+    """Whether digits remain once the battery level and any times are taken out of the text."""
+    if BARE_NUMBER_RE.match(text):
+        return False
+    for pattern in (PERCENT_RE, SOC_RE, MERIDIEM_TIME_RE, DAYPART_TIME_RE, CLOCK_TIME_RE):
+        text = pattern.sub(" ", text)
+    return any(char.isdigit() for char in text)
+
+def parse_registration_value(text: str, input_type: str):
+    """
+    Extracts a registration answer as the string the LLM prompt would have returned.
+
+    Returns None if the value can't be read with confidence.
+    """
+    if input_type == "battery_capacity":
+        value = parse_energy(text)
+    elif input_type == "charging_rate":
+        value = parse_power(text)
+    elif input_type == "departure_time":
+        return parse_time(text)
+    else:
+        raise ValueError(f"Unknown input type {input_type!r}")
+    return None if value is None else f"{value:g}"
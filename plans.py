@@ -0,0 +1,334 @@
+# plans.py
+"""
+Charging plans precomputed for every registered user.
+
+Shortly after the hourly forecast is produced, refresh_plans_job plans every
+user of a zone in one vectorized pass (pred.batch_savings and
+scheduler.batch_schedules). It uses the battery capacity, charging rate and
+default departure saved at registration, at the state of charge the user last
+reported (ASSUMED_SOC if they never did). The plans are kept in PLANS and
+written to the plans table. A charging request whose inputs match the user's
+plan for the current hour is answered from PLANS instead of recomputing it.
+
+Users who opt in with /plans on get their plan pushed once a day at
+PLAN_PUSH_HOUR, at most PLAN_PUSH_RATE messages per second. The day of the
+last push is saved per user, so a restart or a second run in that hour
+doesn't push the same plan again.
+"""
+import asyncio
+import math
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from db import DB
+from forecast_store import FORECASTS, FORECAST_JOB_OFFSET, hour_bucket
+from metrics import METRICS, span
+from pred import batch_savings
+from scheduler import ChargingSchedule, batch_schedules
+from zones import ZONES
+
+# State of charge (%) assumed for users who never reported one
+ASSUMED_SOC = float(os.getenv("PLAN_ASSUMED_SOC", "30"))
+# Local hour at which opted-in users get their plan; empty disables pushes
+PLAN_PUSH_HOUR = int(os.getenv("PLAN_PUSH_HOUR", "19") or -1)
+# Pushed messages per second, below Telegram's limit of about 30 per bot
+PLAN_PUSH_RATE = float(os.getenv("PLAN_PUSH_RATE", "20"))
+# Plans are computed this long after the hourly forecast job
+PLAN_JOB_DELAY = timedelta(minutes=1)
+
+
+@dataclass
+class Plan:
+    """One user's plan, in the form handle_charging_input replies with."""
+    soc: float
+    departure: datetime
+    forecasts: np.ndarray  # savings per feasible start hour, as returned by pred
+    hours_to_charge: float
+    schedule: ChargingSchedule
+
+
+@dataclass
+class PlanBatch:
+    """Plans of every user of one zone, computed together from one forecast."""
+    zone: str
+    hour: datetime
+    produced_at: datetime
+    user_ids: np.ndarray
+    soc: np.ndarray
+    departures: list  # datetime of each user's departure
+    battery_capacity: np.ndarray
+    charging_rate: np.ndarray
+    push: np.ndarray  # whether the user opted in to pushed plans and wasn't pushed one today
+    hours_until_departure: np.ndarray
+    hours_to_charge: np.ndarray
+    savings: np.ndarray  # (n, 48), see pred.batch_savings
+    schedules: dict  # see scheduler.batch_schedules
+    feasible: np.ndarray
+
+    def __post_init__(self):
+        self.rows = {int(user_id): row for row, user_id in enumerate(self.user_ids)}
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def plan(self, row: int) -> Plan:
+        """Returns the plan in `row`; only meaningful if feasible[row]."""
+        horizon = self.savings.shape[1] // 2
+        cost_savings, emission_savings = self.savings[row, :horizon], self.savings[row, horizon:]
+        # Feasible start hours are always a prefix of 0..23
+        num_scenarios = int(np.count_nonzero(~np.isnan(cost_savings)))
+        return Plan(
+            soc=float(self.soc[row]),
+            departure=self.departures[row],
+            forecasts=np.concatenate([cost_savings[:num_scenarios], emission_savings[:num_scenarios]]),
+            hours_to_charge=float(self.hours_to_charge[row]),
+            schedule=ChargingSchedule(
+                energy=self.schedules["energy"][row],
+                power=self.schedules["power"][row],
+                cost=float(self.schedules["cost"][row]),
+                emissions=float(self.schedules["emissions"][row]),
+                cost_savings=float(self.schedules["cost_savings"][row]),
+                emission_savings=float(self.schedules["emission_savings"][row]),
+            ),
+        )
+
+    def db_rows(self) -> list:
+        """Rows for Database.store_plans."""
+        return [
+            (
+                int(user_id), self.zone, self.hour, self.produced_at, float(self.soc[row]),
+                self.departures[row], float(self.battery_capacity[row]), float(self.charging_rate[row]),
+                float(self.hours_to_charge[row]), int(self.feasible[row]),
+                float(self.schedules["cost"][row]), float(self.schedules["emissions"][row]),
+                float(self.schedules["cost_savings"][row]), float(self.schedules["emission_savings"][row]),
+                self.savings[row].tobytes(), self.schedules["energy"][row].tobytes(),
+                self.schedules["power"][row].tobytes(),
+            )
+            for row, user_id in enumerate(self.user_ids)
+        ]
+
+
+def next_departure(departure_time: str, now: datetime):
+    """The next occurrence of a "9:30 AM" departure after `now`, as handle_charging_input computes it."""
+    dt = datetime.strptime(departure_time, "%I:%M %p")
+    dt = dt.replace(year=now.year, month=now.month, day=now.day)
+    if dt < now:
+        dt = dt + timedelta(days=1)
+    return dt
+
+def compute_plans(zone: str, forecasted_24: np.ndarray, users: list, now: datetime) -> PlanBatch:
+    """
+    Plans every user of a zone in one pass.
+
+    Args:
+        zone: The users' zone.
+        forecasted_24: The zone's forecast for the current hour, shape (24, 2).
+        users: (user_id, battery_capacity, charging_rate, departure_time, zone, last_soc, push_plans,
+            plan_pushed_on) rows.
+        now: Time the plans are computed for.
+
+    Returns:
+        PlanBatch
+    """
+    # Departure times are a handful of distinct strings, so each is parsed once
+    departures, parsed = [], {}
+    kept = []
+    for user in users:
+        departure_time = user[3]
+        if departure_time not in parsed:
+            try:
+                parsed[departure_time] = next_departure(departure_time, now)
+            except (TypeError, ValueError):
+                parsed[departure_time] = None
+        if parsed[departure_time] is not None and user[1] and user[2]:
+            kept.append(user)
+            departures.append(parsed[departure_time])
+
+    user_ids = np.array([user[0] for user in kept], dtype=np.int64)
+    battery_capacity = np.array([user[1] for user in kept], dtype=float)
+    charging_rate = np.array([user[2] for user in kept], dtype=float)
+    soc = np.array([ASSUMED_SOC if user[5] is None else user[5] for user in kept], dtype=float)
+    today = now.date().isoformat()
+    push = np.array([bool(user[6]) and user[7] != today for user in kept], dtype=bool)
+    hours_until_departure = np.array([(dt - now).total_seconds() / 3600 for dt in departures], dtype=float)
+
+    savings, hours_to_charge = batch_savings(soc, hours_until_departure, battery_capacity,
+                                             charging_rate, forecasted_24)
+    schedules = batch_schedules(forecasted_24, battery_capacity * (100 - soc) / 100,
+                                charging_rate, hours_until_departure)
+    horizon = len(forecasted_24)
+    # The same conditions under which pred and optimal_schedule would raise
+    feasible = (
+        schedules["feasible"]
+        & (hours_to_charge <= horizon)
+        & (hours_until_departure >= hours_to_charge)
+        & ~np.isnan(savings[:, 0])
+    )
+
+    return PlanBatch(
+        zone=zone,
+        hour=hour_bucket(now),
+        produced_at=now,
+        user_ids=user_ids,
+        soc=soc,
+        departures=departures,
+        battery_capacity=battery_capacity,
+        charging_rate=charging_rate,
+        push=push,
+        hours_until_departure=hours_until_departure,
+        hours_to_charge=hours_to_charge,
+        savings=savings,
+        schedules=schedules,
+        feasible=feasible,
+    )
+
+
+class PlanStore:
+    """The latest PlanBatch of every zone."""
+
+    def __init__(self):
+        self._batches = {}  # zone -> PlanBatch
+
+    def put(self, batch: PlanBatch) -> None:
+        self._batches[batch.zone] = batch
+
+    def __len__(self) -> int:
+        return sum(len(batch) for batch in list(self._batches.values()))
+
+    def lookup(self, user_id, zone: str, soc: float, departure: datetime, battery_capacity: float,
+               charging_rate: float, now: datetime = None):
+        """
+        Returns the user's stored plan if it answers a request with these inputs now, else None.
+
+        The plan was computed earlier in the hour, so besides equal inputs it
+        must still have the same feasible start hours and fit in the time
+        left before departure.
+        """
+        now = now or datetime.now()
+        batch = self._batches.get(zone)
+        if batch is None or batch.hour != hour_bucket(now):
+            return None
+        row = batch.rows.get(user_id)
+        if row is None or not batch.feasible[row]:
+            return None
+        if (batch.soc[row] != soc or batch.departures[row] != departure
+                or batch.battery_capacity[row] != battery_capacity
+                or batch.charging_rate[row] != charging_rate):
+            return None
+
+        hours_until_departure = (departure - now).total_seconds() / 3600
+        planned_hours = batch.hours_until_departure[row]
+        hours_to_charge = batch.hours_to_charge[row]
+        # Start hours pred would offer now
+        if math.floor(hours_until_departure - hours_to_charge) != math.floor(planned_hours - hours_to_charge):
+            return None
+        # Energy planned for the hour of departure must still fit in what is left of it
+        horizon = batch.savings.shape[1] // 2
+        last_slot = math.ceil(planned_hours) - 1
+        if last_slot < horizon:
+            if math.ceil(hours_until_departure) - 1 != last_slot:
+                return None
+            room = charging_rate * (hours_until_departure - last_slot)
+            if batch.schedules["energy"][row, last_slot] > room + 1e-9:
+                return None
+        return batch.plan(row)
+
+
+PLANS = PlanStore()
+
+
+# ---------------------------
+# Scheduled job and pushes
+# ---------------------------
+
+async def push_plans(bot, batch: PlanBatch, format_message, rate: float = PLAN_PUSH_RATE) -> int:
+    """
+    Sends the plans of the batch's opted-in users, at most `rate` messages per second.
+
+    Each user is marked as pushed today as soon as their message is sent, and
+    users who blocked the bot are opted out. Returns the number of messages sent.
+    """
+    from telegram.error import Forbidden, RetryAfter
+
+    loop = asyncio.get_running_loop()
+    next_send = loop.time()
+    sent = 0
+    today = batch.produced_at.date().isoformat()
+    for row in np.flatnonzero(batch.push & batch.feasible):
+        user_id = int(batch.user_ids[row])
+        plan = batch.plan(row)
+        text = (
+            f"Your charging plan, for a battery at {plan.soc:g}% and leaving at "
+            f"{plan.departure.strftime('%I:%M %p')}. Send me your current battery level "
+            "if it's different.\n\n" + format_message(plan.forecasts, plan.hours_to_charge, plan.schedule)
+        )
+        while True:
+            delay = next_send - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_send = max(next_send, loop.time()) + 1 / rate
+            try:
+                await bot.send_message(chat_id=user_id, text=text, parse_mode="Markdown")
+                sent += 1
+                batch.push[row] = False
+                await DB.set_plan_pushed_on(user_id, today)
+                break
+            except RetryAfter as e:
+                # Telegram asks every sender to back off, so the whole push waits and tries again
+                next_send = loop.time() + e.retry_after
+            except Forbidden:
+                await DB.set_push_plans(user_id, False)
+                break
+            except Exception as e:
+                METRICS.inc("evbot_plan_push_failures_total")
+                print(f"Could not push the plan to {user_id}: {e}")
+                break
+    METRICS.inc("evbot_plans_pushed_total", sent)
+    return sent
+
+async def refresh_plans_job(context) -> None:
+    """JobQueue callback that plans every user from the current hour's forecast, and pushes at PLAN_PUSH_HOUR."""
+    emission_api_token, format_message = context.job.data
+    now = datetime.now()
+    users = await DB.get_plan_users()
+    loop = asyncio.get_running_loop()
+
+    for zone in ZONES:
+        zone_users = [user for user in users if user[4] == zone]
+        try:
+            # The hourly job has normally stored this forecast a minute ago
+            record = await FORECASTS.aget_or_compute(emission_api_token, zone)
+            with span("plans"):
+                batch = await loop.run_in_executor(None, compute_plans, zone, record.forecast, zone_users, now)
+            PLANS.put(batch)
+            await DB.store_plans(batch.db_rows())
+        except Exception as e:
+            METRICS.inc("evbot_job_failures_total", job="plans")
+            print(f"Plan refresh failed for {zone}: {e}")
+            continue
+        METRICS.inc("evbot_plans_computed_total", len(batch), zone=zone)
+
+        if now.hour == PLAN_PUSH_HOUR:
+            await push_plans(context.bot, batch, format_message)
+
+def schedule_plans(job_queue, emission_api_token, format_message) -> None:
+    """
+    Schedules refresh_plans_job shortly after every hourly forecast, starting now.
+
+    `format_message(forecasts, hours_to_charge, schedule)` renders pushed plans
+    the way replies to charging requests are rendered.
+    """
+    now = datetime.now()
+    next_run = hour_bucket(now) + timedelta(hours=1) + FORECAST_JOB_OFFSET + PLAN_JOB_DELAY
+    data = (emission_api_token, format_message)
+    job_queue.run_once(refresh_plans_job, when=PLAN_JOB_DELAY, data=data)
+    job_queue.run_repeating(
+        refresh_plans_job,
+        interval=timedelta(hours=1),
+        first=next_run - now,
+        data=data,
+        name="hourly-plans",
+    )
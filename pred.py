@@ -1,11 +1,82 @@
 import numpy as np
 from datetime import datetime, timedelta
 
+def window_totals(forecasted_24, starts, durations) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Integrate the forecast over charging windows [start, start + duration).
+
+    Uses prefix sums of the hourly forecast, interpolated linearly within an hour,
+    so fractional hours are billed for exactly the fraction that is used.
+
+    Args:
+        forecasted_24: forecast of price and emission (shape: (horizon, 2))
+        starts: window start offsets in hours (any shape)
+        durations: window lengths in hours (broadcastable to starts)
+
+    Returns:
+        tuple of arrays (price_hours, emission_hours) with the broadcast shape of
+        starts and durations, i.e. the totals per kW of charging rate
+    """
+    forecasted_24 = np.asarray(forecasted_24, dtype=float)
+    cumulative = np.vstack([np.zeros((1, 2)), np.cumsum(forecasted_24, axis=0)])
+    knots = np.arange(len(cumulative))
+
+    starts = np.asarray(starts, dtype=float)
+    ends = starts + np.asarray(durations, dtype=float)
+    price = np.interp(ends, knots, cumulative[:, 0]) - np.interp(starts, knots, cumulative[:, 0])
+    emission = np.interp(ends, knots, cumulative[:, 1]) - np.interp(starts, knots, cumulative[:, 1])
+    return price, emission
+
+def batch_savings(soc, hours_until_departure, battery_capacity, charging_rate,
+                  forecasted_24) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate cost and emission savings of every start hour for many users at once.
+
+    Args:
+        soc: Current states of charge (percentage), shape (n,)
+        hours_until_departure: Hours from now until each departure, shape (n,)
+        battery_capacity: Battery capacities in kWh, shape (n,)
+        charging_rate: Charging rates in kW, shape (n,)
+        forecasted_24: forecast of price and emission for the next 24 hours (shape: (24, 2))
+
+    Returns:
+        tuple containing:
+            - savings matrix of shape (n, 2 * 24): cost savings for start hours 0..23
+              followed by emission savings, NaN where the start hour is infeasible
+              (charging would not finish before departure or past the forecast)
+            - hours needed to charge, shape (n,)
+    """
+    soc, hours_until_departure, battery_capacity, charging_rate = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(a, dtype=float))
+          for a in (soc, hours_until_departure, battery_capacity, charging_rate))
+    )
+    horizon = len(forecasted_24)
+
+    energy_needed = battery_capacity * (100 - soc) / 100  # kWh
+    hours_to_charge = energy_needed / charging_rate
+
+    starts = np.arange(horizon, dtype=float)
+    ends = starts[None, :] + hours_to_charge[:, None]
+    price_hours, emission_hours = window_totals(
+        forecasted_24, starts[None, :], np.minimum(ends, horizon) - starts[None, :]
+    )
+    cost = price_hours * charging_rate[:, None]
+    emissions = emission_hours * charging_rate[:, None]
+
+    # Start hour must leave enough time before departure and stay within the forecast
+    max_delay_hours = np.floor(hours_until_departure - hours_to_charge)
+    valid = (starts[None, :] <= max_delay_hours[:, None]) & (ends <= horizon)
+
+    # Savings are relative to starting now (start hour 0)
+    cost_savings = np.where(valid, cost[:, :1] - cost, np.nan)
+    emission_savings = np.where(valid, emissions[:, :1] - emissions, np.nan)
+    return np.concatenate([cost_savings, emission_savings], axis=1), hours_to_charge
+
 def pred(soc: float, dt: datetime, battery_capacity: float, charging_rate: float,
          forecasted_24) -> tuple[np.ndarray, float]:
     """
     Calculate cost and emission savings for different EV charging start times.
-    
+
     Args:
         soc: Current state of charge (percentage)
         dt: Departure time (datetime object)
@@ -13,55 +84,29 @@ def pred(soc: float, dt: datetime, battery_capacity: float, charging_rate: float
         charging_rate: Charging rate in kW
         forecasted_24: forecast of price and emission for the next 24 hours (shape: (24, 2))
                       where columns are [price, emission]
-    
+
     Returns:
         tuple containing:
             - numpy array with cost and emission savings for each possible start hour
             - float: hours needed to charge
     """
-    # Calculate energy needed to fully charge
-    energy_needed = battery_capacity * (100 - soc) / 100  # kWh
-    
-    # Calculate hours needed to charge
-    hours_to_charge = energy_needed / charging_rate
-    
     # Calculate how many hours until departure
     now = datetime.now()
     hours_until_departure = (dt - now).total_seconds() / 3600
-    
-    # Maximum number of hours we can delay charging while still finishing before departure
-    max_delay_hours = int(hours_until_departure - hours_to_charge)
-    
-    if max_delay_hours < 0:
+
+    savings, hours = batch_savings(soc, hours_until_departure, battery_capacity,
+                                   charging_rate, forecasted_24)
+    hours_to_charge = float(hours[0])
+    horizon = len(forecasted_24)
+
+    if hours_until_departure < hours_to_charge:
         raise ValueError("Not enough time to charge before departure!")
-    
-    # Calculate baseline cost and emissions (starting now)
-    baseline_cost = 0
-    baseline_emissions = 0
-    hours_charging = int(np.ceil(hours_to_charge))
-    
-    for hour in range(hours_charging):
-        baseline_cost += forecasted_24[hour][0] * charging_rate
-        baseline_emissions += forecasted_24[hour][1] * charging_rate
-    
-    # Initialize arrays to store savings
-    num_scenarios = min(24, max_delay_hours + 1)  # Can't delay more than 24 hours
-    savings = np.zeros(2 * num_scenarios)  # First half for cost savings, second half for emission savings
-    
-    # Calculate savings for each possible delay
-    for delay in range(num_scenarios):
-        delayed_cost = 0
-        delayed_emissions = 0
-        
-        # Calculate cost and emissions for delayed start
-        for hour in range(hours_charging):
-            if delay + hour >= 24:  # Don't access beyond forecasted data
-                break
-            delayed_cost += forecasted_24[delay + hour][0] * charging_rate
-            delayed_emissions += forecasted_24[delay + hour][1] * charging_rate
-        
-        # Calculate and store savings
-        savings[delay] = baseline_cost - delayed_cost  # Cost savings
-        savings[delay + num_scenarios] = baseline_emissions - delayed_emissions  # Emission savings
-    
-    return savings, hours_to_charge
\ No newline at end of file
+    if hours_to_charge > horizon:
+        raise ValueError(f"Charging takes longer than the {horizon}-hour forecast!")
+
+    # Feasible start hours are always a prefix of 0..23
+    cost_savings = savings[0, :horizon]
+    emission_savings = savings[0, horizon:]
+    num_scenarios = int(np.count_nonzero(~np.isnan(cost_savings)))
+
+    return np.concatenate([cost_savings[:num_scenarios], emission_savings[:num_scenarios]]), hours_to_charge
@@ -1,51 +1,29 @@
 # reg.py
-import sqlite3
-import datetime
+from collections import OrderedDict
 from telegram import Update
 from telegram.ext import ContextTypes
+from parsing import parse_charging_input, parse_registration_value
+from db import DB
+from metrics import METRICS, traced, span, set_outcome
+from zones import ZONES
 
-DATABASE_NAME = "bot_database.db"
+# How many extraction requests were answered by the local parser vs. the LLM
+PARSE_STATS = {"fast_path": 0, "llm": 0}
 
 def initialize_database():
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            battery_capacity REAL, 
-            charging_rate REAL,
-            departure_time TEXT 
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS conversations (
-            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            start_time DATETIME,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id INTEGER,
-            sender_type TEXT,
-            message_text TEXT,
-            message_time DATETIME,
-            FOREIGN KEY (conversation_id) REFERENCES conversations(conversation_id)
-        )
-    """)
-
-    conn.commit()
-    conn.close()
-
-initialize_database()
+    """Creates the tables; main() runs this at startup, before any handler."""
+    DB.initialize()
 
 async def process_user_input(user_input: str, input_type: str) -> str:
-    """Process user input using LLM to extract the required information."""
+    """Process user input to extract the required information, using the LLM only if the local parser is unsure."""
+    processed_value = parse_registration_value(user_input, input_type)
+    if processed_value is not None:
+        PARSE_STATS["fast_path"] += 1
+        METRICS.inc("evbot_parse_total", path="fast_path")
+        return processed_value
+    PARSE_STATS["llm"] += 1
+    METRICS.inc("evbot_parse_total", path="llm")
+
     prompts = {
         'battery_capacity': """
             Extract the battery capacity in kWh as a number from the following text. 
@@ -79,12 +57,20 @@ async def process_user_input(user_input: str, input_type: str) -> str:
     }
     
     prompt = prompts[input_type].format(input=user_input)
-    from llm import get_llm_response
-    processed_value = await get_llm_response(prompt, "system")
+    from llm import get_llm_extraction
+    processed_value = await get_llm_extraction(prompt)
     return processed_value.strip()
 
 async def process_charging_input(user_input: str) -> tuple:
-    """Process user input to extract SoC and optional departure time."""
+    """Process user input to extract SoC and optional departure time, using the LLM only if the local parser is unsure."""
+    parsed = parse_charging_input(user_input)
+    if parsed is not None:
+        PARSE_STATS["fast_path"] += 1
+        METRICS.inc("evbot_parse_total", path="fast_path")
+        return parsed
+    PARSE_STATS["llm"] += 1
+    METRICS.inc("evbot_parse_total", path="llm")
+
     prompt = """
     Extract the state of charge (SoC) percentage and optional departure time from the following text.
     Return only two values separated by a comma: SoC number (without % symbol), departure time in HH:MM AM/PM format.
@@ -95,62 +81,97 @@ async def process_charging_input(user_input: str) -> tuple:
     User input: {input}
     """.format(input=user_input)
     
-    from llm import get_llm_response
-    response = await get_llm_response(prompt, "system")
+    from llm import get_llm_extraction
+    response = await get_llm_extraction(prompt)
     soc, departure_time = response.strip().split(',')
     soc = float(soc.strip())
     departure_time = departure_time.strip()
     return soc, None if departure_time == 'None' else departure_time
 
+class ProfileCache:
+    """
+    Bounded LRU cache of user profiles.
+
+    Unregistered users are cached too (as None), so a single lookup answers both
+    "is this user registered?" and "what is their profile?". Profiles only change
+    through store_user_info, which writes the new profile through to the cache.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._profiles = OrderedDict()
+        self._invalidations = 0
+
+    async def get(self, user_id):
+        """Returns (is_registered, profile) for the user, profile being None if not registered."""
+        if user_id in self._profiles:
+            self.hits += 1
+            METRICS.inc("evbot_cache_requests_total", cache="profile", result="hit")
+            self._profiles.move_to_end(user_id)
+            profile = self._profiles[user_id]
+        else:
+            self.misses += 1
+            METRICS.inc("evbot_cache_requests_total", cache="profile", result="miss")
+            invalidations = self._invalidations
+            profile = await DB.get_user_info(user_id)
+            # Don't cache a row that may have been overwritten while we were reading it
+            if invalidations == self._invalidations:
+                self.put(user_id, profile)
+        return profile is not None, profile
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def put(self, user_id, profile) -> None:
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def invalidate(self, user_id) -> None:
+        self._invalidations += 1
+        self._profiles.pop(user_id, None)
+
+
+PROFILES = ProfileCache()
+
+async def get_user_profile(user_id):
+    """Returns (is_registered, profile) from a single cached lookup."""
+    return await PROFILES.get(user_id)
+
 async def is_user_registered(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user is not None
+    registered, _ = await PROFILES.get(user_id)
+    return registered
 
 async def get_user_conversation_id(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT conversation_id FROM conversations WHERE user_id = ? ORDER BY start_time DESC LIMIT 1", (user_id,))
-    conversation = cursor.fetchone()
-    conn.close()
-    return conversation[0] if conversation else None
+    return await DB.get_user_conversation_id(user_id)
 
 async def start_new_conversation(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    now = datetime.datetime.now()
-    cursor.execute("INSERT INTO conversations (user_id, start_time) VALUES (?, ?)", (user_id, now))
-    conn.commit()
-    conversation_id = cursor.lastrowid
-    conn.close()
-    return conversation_id
+    return await DB.start_new_conversation(user_id)
 
 async def store_user_info(user_id, battery_capacity, charging_rate, departure_time):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO users (user_id, battery_capacity, charging_rate, departure_time)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, battery_capacity, charging_rate, departure_time))
-    conn.commit()
-    conn.close()
+    PROFILES.invalidate(user_id)
+    zone = await DB.store_user_info(user_id, battery_capacity, charging_rate, departure_time)
+    PROFILES.put(user_id, {
+        "battery_capacity": battery_capacity,
+        "charging_rate": charging_rate,
+        "departure_time": departure_time,
+        "zone": zone
+    })
+
+async def set_user_zone(user_id, zone):
+    PROFILES.invalidate(user_id)
+    await DB.set_user_zone(user_id, zone)
+
+async def set_last_soc(user_id, soc):
+    """Remembers the user's latest reported state of charge for their precomputed plan."""
+    await DB.set_last_soc(user_id, soc)
 
 async def get_user_info(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT battery_capacity, charging_rate, departure_time FROM users WHERE user_id = ?", (user_id,))
-    user_info = cursor.fetchone()
-    conn.close()
-    if user_info:
-        return {
-            "battery_capacity": user_info[0],
-            "charging_rate": user_info[1],
-            "departure_time": user_info[2]
-        }
-    return None
+    _, profile = await PROFILES.get(user_id)
+    return profile
 
 async def send_welcome_back_message(update: Update) -> None:
     """Sends the welcome back message asking for SoC and departure time."""
@@ -191,6 +212,52 @@ async def edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "You are not registered yet. Please use /start to register first."
         )
 
+async def zone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows the user's grid zone, or changes it with /zone <name>."""
+    user_id = update.effective_user.id
+    profile = await get_user_info(user_id)
+    if profile is None:
+        await update.message.reply_text("You are not registered yet. Please use /start to register first.")
+        return
+
+    available = ", ".join(ZONES)
+    if not context.args:
+        await update.message.reply_text(
+            f"Your zone is {profile['zone']}. Available zones: {available}\n"
+            "Use /zone <name> to change it."
+        )
+        return
+
+    name = context.args[0].upper()
+    if name not in ZONES:
+        await update.message.reply_text(f"Unknown zone {context.args[0]}. Available zones: {available}")
+        return
+    await set_user_zone(user_id, name)
+    await update.message.reply_text(f"Your zone is now {name}.")
+
+async def plans(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows whether the user gets a daily plan pushed, or changes it with /plans on|off."""
+    user_id = update.effective_user.id
+    if await get_user_info(user_id) is None:
+        await update.message.reply_text("You are not registered yet. Please use /start to register first.")
+        return
+
+    if not context.args:
+        enabled = await DB.get_push_plans(user_id)
+        await update.message.reply_text(
+            f"Daily charging plans are {'on' if enabled else 'off'}. "
+            "Use /plans on to get your plan sent every day, /plans off to stop."
+        )
+        return
+
+    choice = context.args[0].lower()
+    if choice not in ("on", "off"):
+        await update.message.reply_text("Use /plans on or /plans off.")
+        return
+    await DB.set_push_plans(user_id, choice == "on")
+    await update.message.reply_text(f"Daily charging plans are now {choice}.")
+
+@traced("registration")
 async def handle_registration_response(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles user responses during registration and edit process."""
     user_id = update.effective_user.id
@@ -199,24 +266,30 @@ async def handle_registration_response(update: Update, context: ContextTypes.DEF
 
     try:
         if step in ['battery_capacity', 'battery_capacity_edit']:
-            processed_value = await process_user_input(user_response, 'battery_capacity')
+            with span("parse"):
+                processed_value = await process_user_input(user_response, 'battery_capacity')
             context.user_data['battery_capacity_temp'] = float(processed_value)
-            await update.message.reply_text("What is your EV charging rate (in kW)? (e.g., 7 kW)")
+            with span("reply"):
+                await update.message.reply_text("What is your EV charging rate (in kW)? (e.g., 7 kW)")
             context.user_data['registration_step'] = 'charging_rate' if step == 'battery_capacity' else 'charging_rate_edit'
             
         elif step in ['charging_rate', 'charging_rate_edit']:
-            processed_value = await process_user_input(user_response, 'charging_rate')
+            with span("parse"):
+                processed_value = await process_user_input(user_response, 'charging_rate')
             context.user_data['charging_rate_temp'] = float(processed_value)
-            await update.message.reply_text("What is your preferred departure time? (e.g., 8:00 AM)")
+            with span("reply"):
+                await update.message.reply_text("What is your preferred departure time? (e.g., 8:00 AM)")
             context.user_data['registration_step'] = 'departure_time' if step == 'charging_rate' else 'departure_time_edit'
             
         elif step in ['departure_time', 'departure_time_edit']:
-            processed_value = await process_user_input(user_response, 'departure_time')
+            with span("parse"):
+                processed_value = await process_user_input(user_response, 'departure_time')
             departure_time = processed_value
             battery_capacity = context.user_data.get('battery_capacity_temp')
             charging_rate = context.user_data.get('charging_rate_temp')
 
-            await store_user_info(user_id, battery_capacity, charging_rate, departure_time)
+            with span("db_write"):
+                await store_user_info(user_id, battery_capacity, charging_rate, departure_time)
 
             # Clear registration data
             context.user_data.pop('registration_step', None)
@@ -224,9 +297,11 @@ async def handle_registration_response(update: Update, context: ContextTypes.DEF
             context.user_data.pop('charging_rate_temp', None)
 
             # Send welcome back message after registration/edit is complete
-            await send_welcome_back_message(update)
+            with span("reply"):
+                await send_welcome_back_message(update)
 
     except ValueError as e:
+        set_outcome("invalid_input")
         await update.message.reply_text("Sorry, I couldn't understand that input. Please try again with a valid number.")
 
 async def is_registration_ongoing(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
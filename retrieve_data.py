@@ -1,72 +1,457 @@
+import csv
+import json
+import os
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
 import numpy as np
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
+from metrics import METRICS, span
+from zones import DEFAULT_ZONE, get_zone
 
-def get_data(emission_api_token):
-    response = requests.get(
-        "https://api.electricitymap.org/v3/carbon-intensity/history?zone=US-NY-NYIS",
-        headers={
-            "auth-token": emission_api_token
-        }
-    )
-    data = response.json()
+# Upstream endpoints can be pointed at a local fixture server for tests
+ELECTRICITYMAPS_BASE_URL = os.getenv("ELECTRICITYMAPS_BASE_URL", "https://api.electricitymap.org/v3")
+NYISO_BASE_URL = os.getenv("NYISO_BASE_URL", "http://mis.nyiso.com/public/csv/realtime")
+# (connect, read) timeouts in seconds per source
+ELECTRICITYMAPS_TIMEOUT = (3.05, 10)
+NYISO_TIMEOUT = (3.05, 20)
+
+FETCH_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix="upstream")
+
+# NYISO publishes real-time LBMPs every 5 minutes and ElectricityMaps updates its
+# history every hour, so a snapshot is good until the next 5-minute boundary
+# (hour boundaries included) plus a little slack for the files to be published.
+REFRESH_INTERVAL = timedelta(minutes=5)
+PUBLISH_DELAY = timedelta(seconds=90)
+# Past this age a snapshot is no longer served while a refresh runs in the background
+MAX_STALENESS = timedelta(hours=1)
+# Missing hours bridged with the nearest observed value; a longer gap fails the fetch
+MAX_FILLED_HOURS = 2
+
+class HttpClient:
+    """
+    Pooled HTTP session shared by all upstream fetches.
+
+    Connections are kept alive between refreshes, and responses carrying an
+    ETag or Last-Modified header are revalidated with a conditional request so
+    an unchanged file is not downloaded again. Only the `max_cached` most
+    recently used responses are kept: NYISO day files have the date in their
+    URL, so an old day's body would otherwise stay in memory for good.
+    """
+
+    def __init__(self, pool_size: int = 8, max_cached: int = 8):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.max_cached = max_cached
+        self._validated = OrderedDict()  # url -> (etag, last_modified, text), least recently used first
+        self._lock = threading.Lock()
+
+    def get_text(self, url: str, timeout, headers=None) -> str:
+        headers = dict(headers or {})
+        with self._lock:
+            cached = self._validated.get(url)
+            if cached:
+                self._validated.move_to_end(url)
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = self.session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached:
+            METRICS.inc("evbot_cache_requests_total", cache="http", result="revalidated")
+            return cached[2]
+        response.raise_for_status()
+
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        with self._lock:
+            if etag or last_modified:
+                self._validated[url] = (etag, last_modified, response.text)
+                self._validated.move_to_end(url)
+                while len(self._validated) > self.max_cached:
+                    self._validated.popitem(last=False)
+            else:
+                self._validated.pop(url, None)
+        return response.text
+
+
+HTTP = HttpClient()
+
+def fetch_carbon_intensity(emission_api_token, carbon_zone: str = "US-NY-NYIS"):
+    """
+    Fetches the past 24 hours of carbon intensity for an ElectricityMaps zone.
+
+    Returns:
+        (carbon_intensity_vector, carbon_times): the values, and the local start
+        hour (naive datetime) each of them was measured in
+    """
+    try:
+        with span("fetch_electricitymaps"):
+            text = HTTP.get_text(
+                f"{ELECTRICITYMAPS_BASE_URL}/carbon-intensity/history?zone={carbon_zone}",
+                timeout=ELECTRICITYMAPS_TIMEOUT,
+                headers={
+                    "auth-token": emission_api_token
+                }
+            )
+    except Exception:
+        METRICS.inc("evbot_upstream_errors_total", source="electricitymaps")
+        raise
+    data = json.loads(text)
 
     carbon_intensity_vector = []
+    carbon_times = []
     for item in data['history']:
         carbon_intensity_vector.append(item['carbonIntensity'])
+        carbon_times.append(_local_hour(item['datetime']))
+    return np.array(carbon_intensity_vector), carbon_times
+
+def _local_hour(stamp: str) -> datetime:
+    """Parses an ISO timestamp ("2024-05-01T10:00:00.000Z") into the naive local hour it starts."""
+    parsed = datetime.fromisoformat(stamp)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.replace(minute=0, second=0, microsecond=0)
+
+def _lines_from(text: str, offset: int):
+    """Yields the lines of `text` starting at `offset`, without copying the rest of it."""
+    while offset < len(text):
+        end = text.find("\n", offset)
+        if end < 0:
+            end = len(text)
+        yield text[offset:end]
+        offset = end + 1
+
+
+class NyisoPriceBuffer:
+    """
+    Rolling window of 5-minute real-time LBMPs for one NYISO zone.
+
+    Day files are parsed incrementally: only the text appended since the file
+    was last seen is read, only the needed columns of the zone's rows are
+    converted, and hourly sums are updated as intervals are added or fall
+    out of the window. Building the hourly price vector is then a lookup of
+    24 sums. Intervals are kept per day, so a day file can be ingested after
+    a later one (e.g. when its download failed earlier). A day file that has
+    been read after the day ended is complete and never fetched again.
+    """
+
+    def __init__(self, zone_name: str = "N.Y.C.", window: timedelta = timedelta(hours=48)):
+        self.zone_name = zone_name
+        self.window = window
+        self._days = {}  # date -> deque of (time stamp, LBMP in $/MWh), oldest first
+        self._hourly = {}  # hour -> [sum of LBMPs, number of intervals]
+        self._offsets = {}  # date -> length of that day's file text already ingested
+        self._complete_days = set()
+        self._lock = threading.Lock()
+
+    def is_complete(self, date: str) -> bool:
+        return date in self._complete_days
+
+    def ingest(self, date: str, text: str, complete: bool = False) -> int:
+        """
+        Adds the intervals of a day file (`date` being YYYYMMDD) not seen before.
+
+        Returns the number of intervals added.
+        """
+        header_end = text.find("\n")
+        header = next(csv.reader([text[:header_end if header_end >= 0 else len(text)]]))
+        time_col, name_col, lbmp_col = (
+            header.index("Time Stamp"), header.index("Name"), header.index("LBMP ($/MWHr)")
+        )
+
+        with self._lock:
+            # Day files only grow, so only the text after what was read last time is new
+            offset = self._offsets.get(date, 0)
+            if offset == 0:
+                offset = header_end + 1 if header_end >= 0 else len(text)
+            intervals = self._days.setdefault(date, deque())
+            last = intervals[-1][0] if intervals else None
+            added = 0
+            for row in csv.reader(_lines_from(text, offset)):
+                if len(row) <= lbmp_col or row[name_col] != self.zone_name:
+                    continue
+                try:
+                    stamp = datetime.strptime(row[time_col], "%m/%d/%Y %H:%M:%S")
+                    lbmp = float(row[lbmp_col])
+                except ValueError:
+                    continue
+                # A day's rows are chronological; anything else is a repeated interval
+                if last is not None and stamp <= last:
+                    continue
+                self._add(intervals, stamp, lbmp)
+                last = stamp
+                added += 1
+
+            self._offsets[date] = max(offset, len(text))
+            if complete:
+                self._complete_days.add(date)
+        return added
+
+    def _add(self, intervals: deque, stamp: datetime, lbmp: float) -> None:
+        intervals.append((stamp, lbmp))
+        totals = self._hourly.setdefault(stamp.replace(minute=0, second=0), [0.0, 0])
+        totals[0] += lbmp
+        totals[1] += 1
+
+    def evict(self, now: datetime) -> None:
+        """Drops intervals that fell out of the window and forgets days that can no longer matter."""
+        cutoff = now - self.window
+        with self._lock:
+            for intervals in self._days.values():
+                while intervals and intervals[0][0] < cutoff:
+                    stamp, lbmp = intervals.popleft()
+                    hour = stamp.replace(minute=0, second=0)
+                    totals = self._hourly[hour]
+                    totals[0] -= lbmp
+                    totals[1] -= 1
+                    if totals[1] == 0:
+                        del self._hourly[hour]
+
+            oldest_date = (cutoff - timedelta(days=1)).strftime("%Y%m%d")
+            for date in [d for d in self._offsets if d < oldest_date]:
+                del self._offsets[date]
+                self._complete_days.discard(date)
+            for date in [d for d, intervals in self._days.items() if not intervals and d < oldest_date]:
+                del self._days[date]
+
+    def hourly_prices(self, end_hour: datetime, hours: int = 24) -> np.ndarray:
+        """Mean price in $/kWh of each of the `hours` hours before `end_hour` (NaN if no data)."""
+        with self._lock:
+            prices = np.full(hours, np.nan)
+            for i in range(hours):
+                totals = self._hourly.get(end_hour - timedelta(hours=hours - i))
+                if totals:
+                    prices[i] = totals[0] / totals[1]
+        return prices / 1000
 
-    # Define the time range: past 24 hours
+
+# One buffer per NYISO price zone
+PRICE_BUFFERS = {}
+_price_buffers_lock = threading.Lock()
+
+def price_buffer(price_zone: str) -> NyisoPriceBuffer:
+    """Returns the rolling price buffer of a NYISO zone, creating it on first use."""
+    with _price_buffers_lock:
+        if price_zone not in PRICE_BUFFERS:
+            PRICE_BUFFERS[price_zone] = NyisoPriceBuffer(price_zone)
+        return PRICE_BUFFERS[price_zone]
+
+def fetch_nyiso_day(date: str) -> str:
+    """Fetches one day of NYISO real-time zonal LBMPs as CSV text, `date` being YYYYMMDD."""
+    try:
+        with span("fetch_nyiso"):
+            return HTTP.get_text(f"{NYISO_BASE_URL}/{date}realtime_zone.csv", timeout=NYISO_TIMEOUT)
+    except Exception:
+        METRICS.inc("evbot_upstream_errors_total", source="nyiso")
+        raise
+
+def fetch_data(emission_api_token, zone: str = DEFAULT_ZONE):
+    """
+    Fetches the past 24 hours of carbon intensity and electricity prices of a zone from the upstream APIs.
+
+    The ElectricityMaps history and the NYISO day files are fetched concurrently;
+    NYISO days that are already fully ingested are not fetched at all.
+
+    Prices are returned at retail level (wholesale times the zone's
+    price_multiplier), the scale the zone's model was trained on. Gaps of up
+    to MAX_FILLED_HOURS are filled (see fill_short_gaps); data with longer gaps
+    raises ValueError, so no forecast is made from it and a cached snapshot
+    keeps being served instead.
+
+    Returns:
+        (carbon_intensity_vector, electricity_price_vector, carbon_times), see fetch_carbon_intensity
+    """
+    zone = get_zone(zone)
+    prices = price_buffer(zone.price_zone)
     end_time = datetime.now()
     start_time = end_time - timedelta(hours=24)
 
-    # NYISO real-time LBMP data URL (data for the past 7 days)
-    base_url = "http://mis.nyiso.com/public/csv/realtime/"
+    # The past 2 days of NYISO files cover the full 24-hour range
+    dates = [(start_time + timedelta(days=i)).strftime("%Y%m%d") for i in range(2)]
+    dates = [date for date in dates if not prices.is_complete(date)]
 
-    # Initialize an empty DataFrame to store the data
-    all_data = pd.DataFrame()
+    carbon_future = FETCH_POOL.submit(fetch_carbon_intensity, emission_api_token, zone.carbon_zone)
+    day_futures = [FETCH_POOL.submit(fetch_nyiso_day, date) for date in dates]
 
-    # Loop through the past 2 days to ensure we cover the full 24-hour range
-    for i in range(2):
-        date = (start_time + timedelta(days=i)).strftime("%Y%m%d")
-        file_url = f"{base_url}{date}realtime_zone.csv"
-        
+    # Days are ingested in order so intervals are appended chronologically
+    for date, future in zip(dates, day_futures):
         try:
-            # Read the CSV file for the specific date
-            daily_data = pd.read_csv(file_url)
-            
-            # Append to the main DataFrame
-            all_data = pd.concat([all_data, daily_data], ignore_index=True)
+            day_end = datetime.strptime(date, "%Y%m%d") + timedelta(days=1)
+            prices.ingest(date, future.result(), complete=end_time >= day_end + PUBLISH_DELAY)
         except Exception as e:
             print(f"Could not retrieve data for {date}: {e}")
+    prices.evict(end_time)
+
+    carbon_intensity_vector, carbon_times = carbon_future.result()
+    # The 24 complete hours before the current one
+    electricity_price_vector = prices.hourly_prices(end_time.replace(minute=0, second=0, microsecond=0))
+    try:
+        electricity_price_vector = fill_short_gaps(electricity_price_vector) * zone.price_multiplier
+    except ValueError as e:
+        raise ValueError(f"NYISO prices for {zone.price_zone} are incomplete: {e}") from None
+    try:
+        carbon_intensity_vector = fill_short_gaps(carbon_intensity_vector)
+    except ValueError as e:
+        raise ValueError(f"ElectricityMaps history for {zone.carbon_zone} is incomplete: {e}") from None
+
+    return carbon_intensity_vector, electricity_price_vector, carbon_times
+
+
+def fill_short_gaps(vector, max_gap: int = MAX_FILLED_HOURS) -> np.ndarray:
+    """
+    Fills runs of at most `max_gap` missing values (NaN or None) with the value before
+    them (after them, for a run at the start).
+
+    Raises:
+        ValueError: if a longer run is missing.
+    """
+    vector = np.array(vector, dtype=float)
+    missing = np.isnan(vector)
+    i = 0
+    while i < len(vector):
+        if not missing[i]:
+            i += 1
+            continue
+        end = i
+        while end < len(vector) and missing[end]:
+            end += 1
+        if end - i > max_gap or (i == 0 and end == len(vector)):
+            raise ValueError(f"{end - i} consecutive hours are missing")
+        vector[i:end] = vector[i - 1] if i > 0 else vector[end]
+        i = end
+    return vector
+
+def next_refresh_time(now: datetime) -> datetime:
+    """Returns the first moment after `now` at which a newer NYISO interval should be available."""
+    published = now - PUBLISH_DELAY
+    boundary = published.replace(
+        minute=published.minute - published.minute % 5, second=0, microsecond=0
+    )
+    return boundary + REFRESH_INTERVAL + PUBLISH_DELAY
+
+
+class MarketDataCache:
+    """
+    Process-wide snapshot of the upstream market data shared by all users.
+
+    A snapshot is fresh until the next NYISO publication. After that it is
+    still served while a single background refresh fetches the new one, so a
+    burst of users costs one upstream fetch instead of one per user. Only when
+    there is no snapshot at all (or it is older than MAX_STALENESS) do callers
+    wait for the fetch themselves.
+    """
+
+    def __init__(self, fetch=fetch_data):
+        self._fetch = fetch
+        self._snapshot = None
+        self._fetched_at = None
+        self._expires_at = None
+        self._refresh_lock = threading.Lock()
+        self._scheduler = None
+
+    def get(self, emission_api_token):
+        """Returns (carbon_intensity_vector, electricity_price_vector), fetching only when needed."""
+        return self.get_observed(emission_api_token)[:2]
+
+    def get_observed(self, emission_api_token):
+        """
+        Like get, but also returns when the values were observed.
+
+        Returns:
+            (carbon_intensity_vector, electricity_price_vector, observed_until, carbon_times):
+            the prices cover the 24 hours before observed_until (earlier than the
+            current hour for a stale snapshot), and carbon_times holds the hour of
+            each carbon intensity
+        """
+        now = datetime.now()
+        snapshot, fetched_at, expires_at = self._snapshot, self._fetched_at, self._expires_at
+        if snapshot is not None:
+            if now < expires_at:
+                METRICS.inc("evbot_cache_requests_total", cache="market_data", result="hit")
+                return snapshot
+            if now - fetched_at < MAX_STALENESS:
+                METRICS.inc("evbot_cache_requests_total", cache="market_data", result="stale")
+                self._refresh_in_background(emission_api_token)
+                return snapshot
+        METRICS.inc("evbot_cache_requests_total", cache="market_data", result="miss")
+        return self.refresh(emission_api_token)
+
+    def refresh(self, emission_api_token, force: bool = False):
+        """Fetches a new snapshot, returned like get_observed. Concurrent callers share a single upstream fetch."""
+        with self._refresh_lock:
+            # Someone else may have refreshed while we were waiting for the lock
+            if not force and self._snapshot is not None and datetime.now() < self._expires_at:
+                return self._snapshot
+
+            # fetch_data covers the 24 complete hours before the hour it starts in
+            observed_until = datetime.now().replace(minute=0, second=0, microsecond=0)
+            carbon_intensity_vector, electricity_price_vector, carbon_times = self._fetch(emission_api_token)
+            # Snapshots are shared between users, so nobody gets to modify them in place
+            carbon_intensity_vector.setflags(write=False)
+            electricity_price_vector.setflags(write=False)
+
+            now = datetime.now()
+            self._snapshot = (carbon_intensity_vector, electricity_price_vector, observed_until, carbon_times)
+            self._fetched_at = now
+            self._expires_at = next_refresh_time(now)
+            return self._snapshot
+
+    def _refresh_in_background(self, emission_api_token):
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(
+            target=self._safe_refresh, args=(emission_api_token,), daemon=True
+        ).start()
+
+    def _safe_refresh(self, emission_api_token, force: bool = False):
+        try:
+            self.refresh(emission_api_token, force=force)
+        except Exception as e:
+            print(f"Market data refresh failed, serving the previous snapshot: {e}")
 
-    # Convert the 'Time Stamp' column to datetime
-    all_data['Time Stamp'] = pd.to_datetime(all_data['Time Stamp'])
+    def start(self, emission_api_token):
+        """Starts a daemon thread that refreshes the snapshot right after every NYISO publication."""
+        if self._scheduler is not None:
+            return
 
-    # Filter data for the 'New York City' zone and the desired time range
-    nyc_data = all_data[
-        (all_data['Name'] == 'N.Y.C.') &
-        (all_data['Time Stamp'] >= start_time) &
-        (all_data['Time Stamp'] <= end_time)
-    ]
+        def run():
+            while True:
+                self._safe_refresh(emission_api_token, force=True)
+                delay = (next_refresh_time(datetime.now()) - datetime.now()).total_seconds()
+                time.sleep(max(delay, 1))
 
-    # Select only the numeric columns along with 'Time Stamp'
-    numeric_columns = ['Time Stamp', 'LBMP ($/MWHr)']
+        self._scheduler = threading.Thread(target=run, name="market-data-refresh", daemon=True)
+        self._scheduler.start()
 
-    # Drop rows with missing or non-numeric 'LBMP ($/MWHr)' values
-    nyc_data = nyc_data[numeric_columns].dropna()
 
-    # Ensure 'LBMP ($/MWHr)' is of numeric type
-    nyc_data['LBMP ($/MWHr)'] = pd.to_numeric(nyc_data['LBMP ($/MWHr)'], errors='coerce')
+# One snapshot per zone, shared by all of the zone's users
+MARKET_DATA = {}
+_market_data_lock = threading.Lock()
 
-    # Resample to hourly intervals by taking the mean of the 5-minute intervals
-    nyc_hourly = nyc_data.resample('h', on='Time Stamp').mean()
+def market_data(zone: str = DEFAULT_ZONE) -> MarketDataCache:
+    """Returns the market data cache of a registered zone, creating it on first use."""
+    get_zone(zone)
+    with _market_data_lock:
+        if zone not in MARKET_DATA:
+            MARKET_DATA[zone] = MarketDataCache(fetch=partial(fetch_data, zone=zone))
+        return MARKET_DATA[zone]
 
-    # Reset index to have 'Time Stamp' as a column
-    nyc_hourly.reset_index(inplace=True)
+def get_data(emission_api_token, zone: str = DEFAULT_ZONE):
+    """
+    Returns the past 24 hours of (carbon_intensity_vector, electricity_price_vector)
+    for a zone from its shared market data snapshot.
+    """
+    return market_data(zone).get(emission_api_token)
 
-    nyc_hourly['LBMP ($/MWHr)'] /= 1000
-    electricity_price_vector = nyc_hourly['LBMP ($/MWHr)'].to_numpy()
-    
-    
-    return np.array(carbon_intensity_vector), np.array(electricity_price_vector)
\ No newline at end of file
+def get_observed_data(emission_api_token, zone: str = DEFAULT_ZONE):
+    """Like get_data, plus when the values were observed (see MarketDataCache.get_observed)."""
+    return market_data(zone).get_observed(emission_api_token)
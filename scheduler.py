@@ -0,0 +1,134 @@
+# scheduler.py
+from dataclasses import dataclass
+
+import numpy as np
+
+OBJECTIVES = ("cost", "emission", "weighted")
+
+
+@dataclass
+class ChargingSchedule:
+    """Recommended hourly charging plan for one user, hour 0 being the current hour."""
+    energy: np.ndarray  # kWh delivered in each hour slot, shape (24,)
+    power: np.ndarray  # kW to charge at during the usable part of each slot, shape (24,)
+    cost: float  # $
+    emissions: float  # g CO2
+    cost_savings: float  # $ saved compared to charging at full rate right away
+    emission_savings: float  # g CO2 saved compared to charging at full rate right away
+
+
+def hour_scores(forecasted_24, objective: str = "cost", weight: float = 0.5) -> np.ndarray:
+    """
+    Scores each forecast hour for the given objective; lower is better.
+
+    'weighted' mixes price and emission, each normalized by its mean absolute
+    value (unless that is zero), with `weight` on price and `1 - weight` on emission.
+    """
+    forecasted_24 = np.asarray(forecasted_24, dtype=float)
+    price, emission = forecasted_24[:, 0], forecasted_24[:, 1]
+    if objective == "cost":
+        return price
+    if objective == "emission":
+        return emission
+    if objective == "weighted":
+        # An all-zero series would divide by zero; it has nothing to normalize anyway
+        price_scale = np.abs(price).mean() or 1.0
+        emission_scale = np.abs(emission).mean() or 1.0
+        return weight * price / price_scale + (1 - weight) * emission / emission_scale
+    raise ValueError(f"Unknown objective {objective!r}, expected one of {OBJECTIVES}")
+
+def slot_fractions(hours_until_departure, horizon: int = 24) -> np.ndarray:
+    """Usable fraction of each hour slot before departure, shape (n, horizon)."""
+    hours_until_departure = np.atleast_1d(np.asarray(hours_until_departure, dtype=float))
+    return np.clip(hours_until_departure[:, None] - np.arange(horizon), 0, 1)
+
+def _allocate(capacities: np.ndarray, energy_needed: np.ndarray, order: np.ndarray) -> np.ndarray:
+    """Fills slots in `order` up to their capacity until each user's energy is delivered."""
+    sorted_caps = capacities[:, order]
+    filled_before = np.cumsum(sorted_caps, axis=1) - sorted_caps
+    sorted_energy = np.clip(energy_needed[:, None] - filled_before, 0, sorted_caps)
+    energy = np.empty_like(sorted_energy)
+    energy[:, order] = sorted_energy
+    return energy
+
+def batch_schedules(forecasted_24, energy_needed, max_rate, hours_until_departure,
+                    objective: str = "cost", weight: float = 0.5) -> dict:
+    """
+    Optimal (not necessarily contiguous) charging schedules for many users.
+
+    Every user shares the same forecast, so the hours are ranked once and each
+    user's energy is poured into the best-ranked hours before their departure,
+    at up to `max_rate` per hour and pro rata in the final partial hour. That
+    greedy fill is optimal because cost and emissions are linear in energy.
+
+    Args:
+        forecasted_24: forecast of price and emission for the next 24 hours (shape: (24, 2))
+        energy_needed: kWh to deliver per user, shape (n,)
+        max_rate: maximum charging rate in kW per user, shape (n,)
+        hours_until_departure: hours from now until each departure, shape (n,)
+        objective: 'cost', 'emission' or 'weighted'
+        weight: weight on price for the 'weighted' objective
+
+    Returns:
+        dict with arrays 'energy' and 'power' of shape (n, 24), 'cost', 'emissions',
+        'cost_savings', 'emission_savings' and 'feasible' of shape (n,)
+    """
+    forecasted_24 = np.asarray(forecasted_24, dtype=float)
+    horizon = len(forecasted_24)
+    energy_needed, max_rate, hours_until_departure = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(a, dtype=float))
+          for a in (energy_needed, max_rate, hours_until_departure))
+    )
+
+    fractions = slot_fractions(hours_until_departure, horizon)
+    capacities = max_rate[:, None] * fractions
+    feasible = capacities.sum(axis=1) >= energy_needed - 1e-9
+
+    order = np.argsort(hour_scores(forecasted_24, objective, weight), kind="stable")
+    energy = _allocate(capacities, energy_needed, order)
+    immediate = _allocate(capacities, energy_needed, np.arange(horizon))
+
+    power = np.divide(energy, fractions, out=np.zeros_like(energy), where=fractions > 0)
+    cost, emissions = (energy @ forecasted_24).T
+    immediate_cost, immediate_emissions = (immediate @ forecasted_24).T
+
+    return {
+        "energy": energy,
+        "power": power,
+        "cost": cost,
+        "emissions": emissions,
+        "cost_savings": immediate_cost - cost,
+        "emission_savings": immediate_emissions - emissions,
+        "feasible": feasible,
+    }
+
+def optimal_schedule(forecasted_24, energy_needed: float, max_rate: float,
+                     hours_until_departure: float, objective: str = "cost",
+                     weight: float = 0.5) -> ChargingSchedule:
+    """
+    Cheapest (or cleanest) hourly charging plan for one user.
+
+    Args:
+        forecasted_24: forecast of price and emission for the next 24 hours (shape: (24, 2))
+        energy_needed: kWh to deliver
+        max_rate: maximum charging rate in kW
+        hours_until_departure: hours from now until departure
+        objective: 'cost', 'emission' or 'weighted'
+        weight: weight on price for the 'weighted' objective
+
+    Returns:
+        ChargingSchedule
+    """
+    result = batch_schedules(forecasted_24, energy_needed, max_rate, hours_until_departure,
+                             objective, weight)
+    if not result["feasible"][0]:
+        raise ValueError("Not enough time to charge before departure!")
+
+    return ChargingSchedule(
+        energy=result["energy"][0],
+        power=result["power"][0],
+        cost=float(result["cost"][0]),
+        emissions=float(result["emissions"][0]),
+        cost_savings=float(result["cost_savings"][0]),
+        emission_savings=float(result["emission_savings"][0]),
+    )
@@ -0,0 +1,63 @@
+# test_parsing.py
+import pytest
+
+from parsing import parse_charging_input, parse_registration_value
+
+# Messages answered without the LLM, and the (soc, departure_time) read from them
+ACCEPTED = [
+    ("45", (45.0, None)),
+    ("45%", (45.0, None)),
+    ("45% leave at 7am", (45.0, "7:00 AM")),
+    ("soc 45, 07:00", (45.0, "7:00 AM")),
+    ("battery at 45% leaving 19:00", (45.0, "7:00 PM")),
+    ("45 percent, leaving at 8 in the morning", (45.0, "8:00 AM")),
+    ("62.5% tonight at 11:30 pm", (62.5, "11:30 PM")),
+    ("45% noon", (45.0, "12:00 PM")),
+]
+
+# Messages that must be left to the LLM
+UNSURE = [
+    "7:30",  # a time but no battery level
+    "45%, 7",  # the 7 is not accounted for
+    "45% leave 7h30",  # morning or evening?
+    "45% leave at 7:30",
+    "battery 45 at 7:30",
+    "45% or 50%",
+    "150%",
+    "20% for my 2019 tesla",
+    "half full",
+]
+
+
+@pytest.mark.parametrize("text, expected", ACCEPTED)
+def test_charging_input_accepted(text, expected):
+    assert parse_charging_input(text) == expected
+
+
+@pytest.mark.parametrize("text", UNSURE)
+def test_charging_input_left_to_llm(text):
+    assert parse_charging_input(text) is None
+
+
+@pytest.mark.parametrize("text, input_type, expected", [
+    ("75 kWh", "battery_capacity", "75"),
+    ("my tesla has a 76.2kwh battery", "battery_capacity", "76.2"),
+    ("1,000 kWh", "battery_capacity", "1000"),
+    ("75,5 kwh", "battery_capacity", "75.5"),
+    ("it charges at 7.4kw at home", "charging_rate", "7.4"),
+    ("11", "charging_rate", "11"),
+    ("i leave at 8:30 in the morning", "departure_time", "8:30 AM"),
+    ("07:30", "departure_time", "7:30 AM"),
+])
+def test_registration_value_accepted(text, input_type, expected):
+    assert parse_registration_value(text, input_type) == expected
+
+
+@pytest.mark.parametrize("text, input_type", [
+    ("7kw or 11kw", "charging_rate"),
+    ("7 kw", "battery_capacity"),
+    ("7:30", "departure_time"),
+    ("around eight", "departure_time"),
+])
+def test_registration_value_left_to_llm(text, input_type):
+    assert parse_registration_value(text, input_type) is None
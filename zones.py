@@ -0,0 +1,112 @@
+# zones.py
+"""
+Registry of the grid zones the bot can plan for.
+
+Each zone names where its live data comes from (an ElectricityMaps carbon
+zone and a NYISO real-time price zone), which model artifacts forecast it,
+the wholesale-to-retail price multiplier and the raw files data_collection.py
+builds its training history from. Market data, forecasts and models are all
+shared per zone, so every user in a zone costs one fetch and one inference
+per hour no matter how many users there are.
+
+To add a zone, collect and train its history (or reuse an existing model)
+and register it in ZONES.
+
+The history and models committed under data_processing/ are only a snapshot.
+The running bot appends to its history and fine-tunes its models in
+RUNTIME_DIR (gitignored, mirroring the layout of data_processing/), which is
+seeded from the snapshot the first time a zone's files are needed.
+"""
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(REPO_ROOT, "data_processing")
+RUNTIME_DIR = os.path.abspath(os.getenv("RUNTIME_DIR", os.path.join(REPO_ROOT, "runtime")))
+
+
+def runtime_path(seed_path: str) -> str:
+    """The copy in RUNTIME_DIR of a file or directory committed under DATA_DIR."""
+    return os.path.join(RUNTIME_DIR, os.path.relpath(seed_path, DATA_DIR))
+
+def seed_path(path: str) -> str:
+    """The committed snapshot under DATA_DIR that a path in RUNTIME_DIR is seeded from."""
+    return os.path.join(DATA_DIR, os.path.relpath(path, RUNTIME_DIR))
+
+
+@dataclass(frozen=True)
+class Zone:
+    name: str
+    carbon_zone: str  # ElectricityMaps zone
+    price_zone: str  # "Name" of the zone in NYISO's real-time zonal LBMP files
+    price_multiplier: float  # wholesale $/kWh -> approximate residential $/kWh
+    model_path: str  # Keras model, in RUNTIME_DIR
+    npz_path: str  # the same model exported for the NumPy backend, in RUNTIME_DIR
+    history_store: str  # HistoryStore of the hourly prices and emissions the model is trained on, in RUNTIME_DIR
+    lbmp_file: str  # raw NYISO LBMP export used by data_collection.py
+    emission_file: str  # raw ElectricityMaps export used by data_collection.py
+
+
+ZONES = {
+    zone.name: zone for zone in [
+        Zone(
+            name="NYC",
+            carbon_zone="US-NY-NYIS",
+            price_zone="N.Y.C.",
+            # Residential 27.2 c/kWh over wholesale 6.42 c/kWh, see data_collection.py
+            price_multiplier=4.24,
+            model_path=runtime_path(os.path.join(DATA_DIR, "trained_model.h5")),
+            npz_path=runtime_path(os.path.join(DATA_DIR, "trained_model.npz")),
+            history_store=runtime_path(os.path.join(DATA_DIR, "history", "NYC")),
+            lbmp_file=os.path.join(DATA_DIR, "OASIS_Real_Time_Dispatch_Zonal_LBMP.csv"),
+            emission_file=os.path.join(DATA_DIR, "US-NY-NYIS_2024_hourly.csv"),
+        ),
+    ]
+}
+
+DEFAULT_ZONE = "NYC"
+
+def get_zone(name: str = None) -> Zone:
+    """Returns the registered zone called `name` (the default zone if None)."""
+    try:
+        return ZONES[name or DEFAULT_ZONE]
+    except KeyError:
+        raise ValueError(f"Unknown zone: {name}") from None
+
+_seed_lock = threading.Lock()
+
+def ensure_runtime_data(name: str = None) -> Zone:
+    """
+    Copies a zone's model files and history from the committed snapshot into
+    RUNTIME_DIR, unless they are already there. Returns the zone.
+
+    Each copy is written next to its destination and renamed into place, so a
+    process seeding at the same time, or an interrupted one, never leaves a
+    partial copy behind.
+    """
+    zone = get_zone(name)
+    with _seed_lock:
+        for path in (zone.model_path, zone.npz_path, zone.history_store):
+            if os.path.exists(path):
+                continue
+            source = seed_path(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.seed-{os.getpid()}"
+            if os.path.isdir(source):
+                shutil.copytree(source, tmp_path)
+            else:
+                shutil.copy2(source, tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # Another process seeded it first
+                if not os.path.exists(path):
+                    raise
+            finally:
+                if os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+                elif os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return zone